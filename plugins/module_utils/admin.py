@@ -0,0 +1,126 @@
+GRANT = "grant"
+REVOKE = "revoke"
+
+# Label used in change records for the super admin role, whatever its name
+SUPER_ADMIN = "super_admin"
+
+
+class AdminChange:
+    __slots__ = ("operation", "role_name", "role_id", "assignment_id")
+
+    def __init__(self, operation, role_name, role_id=None, assignment_id=None):
+        self.operation = operation
+        self.role_name = role_name
+        self.role_id = role_id
+        self.assignment_id = assignment_id
+
+    def record(self, client, email):
+        held = self.operation == REVOKE
+        client.record_change(
+            self.operation,
+            f"user/{email}/role/{self.role_name}",
+            {"assigned": held},
+            {"assigned": not held},
+        )
+
+    def request(self, client, email, user_id):
+        # Super admin status is toggled with makeAdmin; other roles are granted
+        # to the user's ID and revoked by assignment
+        if self.role_id is None:
+            return client.client.users().makeAdmin(
+                userKey=email, body={"status": self.operation == GRANT}
+            )
+        if self.operation == GRANT:
+            return client.client.roleAssignments().insert(
+                customer="my_customer",
+                body={
+                    "roleId": self.role_id,
+                    "assignedTo": user_id,
+                    "scopeType": "CUSTOMER",
+                },
+            )
+        return client.client.roleAssignments().delete(
+            customer="my_customer", roleAssignmentId=self.assignment_id
+        )
+
+    def message(self, email):
+        if self.operation == GRANT:
+            return f"Granted role: {self.role_name} to user: {email}"
+        return f"Revoked role: {self.role_name} from user: {email}"
+
+
+def plan_super_admin(user, is_admin):
+    # Super admin status comes from the user's isAdmin field and is changed
+    # with makeAdmin, so it needs no role listing. user is None for a user not
+    # created yet.
+    if is_admin == bool(user and user.get("isAdmin")):
+        return []
+    return [AdminChange(GRANT if is_admin else REVOKE, SUPER_ADMIN)]
+
+
+class RoleIndex:
+    # Every role assignment in the customer, indexed by user ID, so custom
+    # admin roles are compared without reading users one at a time. Listing
+    # roles needs the admin.directory.rolemanagement scope.
+    def __init__(self, roles, assignments):
+        self.role_ids = {role["roleName"]: role["roleId"] for role in roles}
+        self.role_names = {role["roleId"]: role["roleName"] for role in roles}
+        self.super_admin_role_ids = {
+            role["roleId"] for role in roles if role.get("isSuperAdminRole")
+        }
+        self.assignments = {}
+        for assignment in assignments:
+            held = self.assignments.setdefault(assignment["assignedTo"], {})
+            held.setdefault(assignment["roleId"], []).append(
+                assignment["roleAssignmentId"]
+            )
+
+    def plan(self, user_id, role_names):
+        # Returns AdminChange records taking the user from the custom roles it
+        # holds to the declared ones. user_id is None for a user not created
+        # yet. Super admin roles are left to plan_super_admin; unknown role
+        # names raise ValueError.
+        unknown = sorted(set(role_names) - self.role_ids.keys())
+        if unknown:
+            raise ValueError(f"Unknown admin roles: {', '.join(unknown)}")
+        wanted = {self.role_ids[name] for name in role_names}
+        held = self.assignments.get(user_id, {})
+        custom = held.keys() - self.super_admin_role_ids
+        wanted -= self.super_admin_role_ids
+        changes = []
+        for role_id in sorted(wanted - custom):
+            changes.append(AdminChange(GRANT, self.role_names[role_id], role_id))
+        for role_id in sorted(custom - wanted):
+            for assignment_id in held[role_id]:
+                changes.append(
+                    AdminChange(
+                        REVOKE, self.role_names[role_id], role_id, assignment_id
+                    )
+                )
+        return changes
+
+
+def load_role_index(client, user_key=None, with_assignments=True):
+    # Two paginated listings for the whole customer. user_key narrows the
+    # assignments to one user; a user that doesn't exist yet needs none.
+    roles = list(
+        client.paginate(
+            client.client.roles().list,
+            customer="my_customer",
+            maxResults=100,
+            fields="items(roleId,roleName,isSuperAdminRole),nextPageToken",
+        )
+    )
+    assignments = []
+    if with_assignments:
+        filters = {} if user_key is None else {"userKey": user_key}
+        assignments = list(
+            client.paginate(
+                client.client.roleAssignments().list,
+                customer="my_customer",
+                maxResults=200,
+                fields="items(roleAssignmentId,roleId,assignedTo),nextPageToken",
+                **filters,
+            )
+        )
+    return RoleIndex(roles, assignments)
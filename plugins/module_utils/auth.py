@@ -0,0 +1,88 @@
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+
+# Cached tokens expiring sooner than this are refreshed instead of reused
+EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+
+
+def token_cache_key(service_account, subject, scopes):
+    key = json.dumps([service_account, subject, sorted(scopes)])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def read_token(f, key):
+    f.seek(0)
+    try:
+        entry = json.load(f)[key]
+        expiry = datetime.datetime.fromisoformat(entry["expiry"])
+    except (ValueError, KeyError, TypeError):
+        return None, None
+    if expiry - EXPIRY_MARGIN <= datetime.datetime.utcnow():
+        return None, None
+    return entry["token"], expiry
+
+
+def write_token(f, key, token, expiry):
+    f.seek(0)
+    try:
+        tokens = json.load(f)
+    except ValueError:
+        tokens = {}
+    # Drop expired entries so the file doesn't grow with every subject
+    now = datetime.datetime.utcnow().isoformat()
+    tokens = {k: v for k, v in tokens.items() if v.get("expiry", "") > now}
+    tokens[key] = {"token": token, "expiry": expiry.isoformat()}
+    f.seek(0)
+    f.truncate()
+    json.dump(tokens, f)
+    f.flush()
+
+
+def load_cached_credentials(credentials, key, cache_path):
+    # The file is only ever readable by its owner, and the exclusive lock is
+    # held across the refresh so concurrent tasks mint a single token
+    import google_auth_httplib2
+    import httplib2
+
+    cache_path = os.path.expanduser(cache_path)
+    fd = os.open(cache_path, os.O_RDWR | os.O_CREAT, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "r+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            token, expiry = read_token(f, key)
+            if token is None:
+                credentials.refresh(google_auth_httplib2.Request(httplib2.Http()))
+                write_token(f, key, credentials.token, credentials.expiry)
+            else:
+                credentials.token = token
+                credentials.expiry = expiry
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return credentials
+
+
+def get_credentials(module):
+    from google.oauth2 import service_account
+
+    info = module.params["auth_dictionary"]
+    scopes = module.params["auth_scopes"]
+    subject = module.params["auth_email"]
+    credentials = service_account.Credentials.from_service_account_info(
+        info, scopes=scopes, subject=subject
+    )
+    cache_path = module.params.get("token_cache_path")
+    if cache_path:
+        key = token_cache_key(info.get("client_email"), subject, scopes)
+        credentials = load_cached_credentials(credentials, key, cache_path)
+    return credentials
+
+
+def authorized_http(credentials):
+    import google_auth_httplib2
+    import httplib2
+
+    return google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
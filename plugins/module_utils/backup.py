@@ -0,0 +1,1001 @@
+import base64
+import hashlib
+import io
+import json
+import lzma
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from ansible_collections.striveworks.gws.plugins.module_utils.gws import (
+    GWSClient,
+    gws_argument_spec,
+)
+
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+# Per-file checksums stored inside every archive
+MANIFEST_NAME = "manifest.json"
+
+ARCHIVE_EXTENSIONS = {
+    "zip_stored": "zip",
+    "zip_deflate": "zip",
+    "tar_zstd": "tar.zst",
+    "tar_xz": "tar.xz",
+}
+DEFAULT_COMPRESSION_LEVELS = {
+    "zip_stored": 0,
+    "zip_deflate": zlib.Z_DEFAULT_COMPRESSION,
+    "tar_zstd": 3,
+    "tar_xz": 6,
+}
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Data Transfer API applications, with the transfer parameters each one takes
+TRANSFER_APPLICATIONS = {
+    "drive": {
+        "applicationId": "55656082996",
+        "applicationTransferParams": [
+            {"key": "PRIVACY_LEVEL", "value": ["PRIVATE", "SHARED"]}
+        ],
+    },
+    "calendar": {
+        "applicationId": "435070579839",
+        "applicationTransferParams": [{"key": "RELEASE_RESOURCES", "value": ["TRUE"]}],
+    },
+    "looker_studio": {"applicationId": "810260081642"},
+}
+
+# Vault search options and export options for each corpus
+EXPORT_OPTIONS = {
+    "MAIL": (
+        {"mailOptions": {"excludeDrafts": False}},
+        {
+            "mailOptions": {
+                "exportFormat": "MBOX",
+                "showConfidentialModeContent": True,
+                "useNewExport": True,
+            }
+        },
+    ),
+    "DRIVE": (
+        {"driveOptions": {"includeSharedDrives": True}},
+        {"driveOptions": {"includeAccessInfo": True}},
+    ),
+    "GROUPS": ({}, {"groupsOptions": {"exportFormat": "MBOX"}}),
+    "HANGOUTS_CHAT": (
+        {"hangoutsChatOptions": {"includeRooms": True}},
+        {"hangoutsChatOptions": {"exportFormat": "MBOX"}},
+    ),
+}
+
+# Bounds, in seconds, for the Vault export polling interval
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 60
+
+
+def backup_argument_spec():
+    argument_spec = gws_argument_spec()
+    # Backups run jobs rather than reconcile resources, so have no change plan
+    del argument_spec["plan_path"]
+    argument_spec.update(
+        {
+            "receiver": {"type": "str", "required": True},
+            "matter_owner": {"type": "str", "required": True},
+            "bucket_name": {"type": "str", "required": True},
+            "download_path": {"type": "str", "required": False},
+            "storage_creds_path": {"type": "str", "required": True},
+            "download_workers": {"type": "int", "default": 4},
+            # Downloads request this many bytes per chunk
+            "download_chunk_size": {"type": "int", "default": 64 * 1024 * 1024},
+            # Must be a multiple of 256 KiB
+            "upload_chunk_size": {"type": "int", "default": 64 * 1024 * 1024},
+            "archive_mode": {
+                "type": "str",
+                "default": "local",
+                "choices": ["local", "stream", "server_side"],
+            },
+            "export_timeout": {"type": "int", "default": 600},
+            "transfer_applications": {
+                "type": "list",
+                "elements": "str",
+                "default": ["drive"],
+                "choices": list(TRANSFER_APPLICATIONS),
+            },
+            # Transfers are polled alongside the export until they finish
+            "transfer_timeout": {"type": "int", "default": 3600},
+            "archive_format": {
+                "type": "str",
+                "default": "zip_deflate",
+                "choices": list(ARCHIVE_EXTENSIONS),
+            },
+            # Defaults to the format's own default level
+            "compression_level": {"type": "int", "required": False},
+            # Threads compressing files in parallel; defaults to the CPU count
+            "compression_workers": {"type": "int", "required": False},
+        }
+    )
+    return argument_spec
+
+
+def compression_stats(input_bytes, output_bytes, start):
+    seconds = time.monotonic() - start
+    return {
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+        "ratio": round(input_bytes / output_bytes, 3) if output_bytes else None,
+        "seconds": round(seconds, 3),
+        "bytes_per_second": round(input_bytes / max(seconds, 0.001)),
+    }
+
+
+def transfer_stats(files, total_bytes, start):
+    seconds = time.monotonic() - start
+    return {
+        "files": files,
+        "bytes": total_bytes,
+        "seconds": round(seconds, 3),
+        "bytes_per_second": round(total_bytes / max(seconds, 0.001)),
+    }
+
+
+class Checksum:
+    # MD5 and, when google-crc32c is installed, CRC32C of a stream, encoded the
+    # way GCS reports them in object metadata
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.crc32c = google_crc32c.Checksum() if google_crc32c else None
+        self.size = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        if self.crc32c is not None:
+            self.crc32c.update(data)
+        self.size += len(data)
+
+    def encoded(self):
+        checksums = {
+            "size": self.size,
+            "md5Hash": base64.b64encode(self.md5.digest()).decode(),
+        }
+        if self.crc32c is not None:
+            checksums["crc32c"] = base64.b64encode(self.crc32c.digest()).decode()
+        return checksums
+
+
+class ChecksumWriter:
+    # Checksums data on its way to fp. It has no seek(), so zipfile writes data
+    # descriptors instead of rewriting headers and every byte is hashed once.
+    def __init__(self, fp):
+        self.fp = fp
+        self.checksum = Checksum()
+
+    def write(self, data):
+        self.fp.write(data)
+        self.checksum.update(data)
+        return len(data)
+
+    def tell(self):
+        return self.checksum.size
+
+    def flush(self):
+        self.fp.flush()
+
+
+def verify_checksums(name, expected, actual):
+    # Only compares the checksums both sides have
+    for key in ("md5Hash", "crc32c"):
+        if expected.get(key) and actual.get(key) and expected[key] != actual[key]:
+            raise BackupError(
+                f"Checksum mismatch for {name}: {key} is {actual[key]}, expected {expected[key]}"
+            )
+    if int(expected.get("size", actual["size"])) != int(actual["size"]):
+        raise BackupError(
+            f"Size mismatch for {name}: {actual['size']} bytes, expected {expected['size']}"
+        )
+
+
+def next_upload_offset(resp):
+    # A 308 response's Range header ("bytes=0-N") covers what GCS has persisted
+    if "Range" not in resp.headers:
+        return 0
+    return int(resp.headers["Range"].split("-")[-1]) + 1
+
+
+def deflate_file(source_path, compressed_path, level):
+    # Raw deflate stream plus the CRC32 and sizes a zip entry header needs.
+    # zlib releases the GIL, so several of these run in parallel on threads.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    with open(source_path, "rb") as src, open(compressed_path, "wb") as dst:
+        for chunk in iter(lambda: src.read(COPY_BUFFER_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            dst.write(compressor.compress(chunk))
+        dst.write(compressor.flush())
+        compress_size = dst.tell()
+    return crc, size, compress_size
+
+
+def write_deflated_entry(zipf, name, source_path, compressed_path, deflated):
+    # zipfile can only compress entries itself, one at a time, so entries
+    # compressed by deflate_file are written with their header the same way
+    # ZipFile.open() does it
+    crc, size, compress_size = deflated
+    zinfo = zipfile.ZipInfo.from_file(source_path, name)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = compress_size
+    zinfo.header_offset = zipf.fp.tell()
+    zipf.fp.write(zinfo.FileHeader(None))
+    with open(compressed_path, "rb") as src:
+        shutil.copyfileobj(src, zipf.fp, COPY_BUFFER_SIZE)
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[name] = zinfo
+    zipf.start_dir = zipf.fp.tell()
+
+
+def write_zip(out, path, files, manifest, archive_format, level, workers):
+    if archive_format == "zip_stored":
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_STORED) as zipf:
+            for file_name in files:
+                zipf.write(os.path.join(path, file_name), file_name)
+            zipf.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+        return
+
+    with tempfile.TemporaryDirectory(dir=path) as tmp_dir:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(
+                    deflate_file,
+                    os.path.join(path, file_name),
+                    os.path.join(tmp_dir, str(index)),
+                    level,
+                )
+                for index, file_name in enumerate(files)
+            ]
+            with zipfile.ZipFile(
+                out, "w", zipfile.ZIP_DEFLATED, compresslevel=level
+            ) as zipf:
+                for index, (file_name, future) in enumerate(zip(files, futures)):
+                    compressed_path = os.path.join(tmp_dir, str(index))
+                    write_deflated_entry(
+                        zipf,
+                        file_name,
+                        os.path.join(path, file_name),
+                        compressed_path,
+                        future.result(),
+                    )
+                    os.remove(compressed_path)
+                zipf.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+
+
+def write_tar(stream, path, files, manifest):
+    with tarfile.open(fileobj=stream, mode="w|") as tar:
+        for file_name in files:
+            tar.add(os.path.join(path, file_name), arcname=file_name)
+        data = json.dumps(manifest, indent=2).encode()
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+
+
+def write_tar_zstd(out, path, files, manifest, level, workers):
+    try:
+        import zstandard
+    except ImportError:
+        raise BackupError("The tar_zstd archive format requires zstandard")
+
+    compressor = zstandard.ZstdCompressor(level=level, threads=workers)
+    with compressor.stream_writer(out, closefd=False) as stream:
+        write_tar(stream, path, files, manifest)
+
+
+def write_tar_xz(out, path, files, manifest, level, workers):
+    # Python's lzma is single-threaded, so the xz binary is used when present
+    xz = shutil.which("xz")
+    if xz is None:
+        with lzma.open(out, "wb", preset=level) as stream:
+            write_tar(stream, path, files, manifest)
+        return
+
+    proc = subprocess.Popen(
+        [xz, f"-{level}", f"--threads={workers}", "--stdout"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    errors = []
+
+    def pump():
+        try:
+            shutil.copyfileobj(proc.stdout, out, COPY_BUFFER_SIZE)
+        except Exception as e:
+            # Nothing drains xz any more, so it's stopped rather than left
+            # blocking on a full pipe, and the writer below gets a broken pipe
+            errors.append(e)
+            proc.kill()
+
+    pump_thread = threading.Thread(target=pump)
+    pump_thread.start()
+    try:
+        write_tar(proc.stdin, path, files, manifest)
+    except Exception:
+        proc.kill()
+        if not errors:
+            raise
+    finally:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        pump_thread.join()
+        proc.wait()
+    if errors:
+        raise BackupError(f"Failed to write xz archive\n{errors[0]}")
+    if proc.returncode != 0:
+        raise BackupError(f"xz exited with status {proc.returncode}")
+
+
+class Checkpoint:
+    # Records how far a backup got so a rerun resumes from the last completed
+    # stage. Without a path the state is only kept in memory.
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {}
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.state.get(key, default)
+
+    def update(self, **values):
+        with self.lock:
+            self.state.update(values)
+            self.save()
+
+    def record_file(self, object_name, **values):
+        with self.lock:
+            self.state.setdefault("files", {})[object_name] = values
+            self.save()
+
+    def section(self, name):
+        # A view of state[name] saved to the same file under the same lock, for
+        # stages that run once per export
+        with self.lock:
+            state = self.state.setdefault(name, {})
+        return CheckpointSection(self, state)
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class CheckpointSection(Checkpoint):
+    def __init__(self, parent, state):
+        self.parent = parent
+        self.path = parent.path
+        self.lock = parent.lock
+        self.state = state
+
+    def save(self):
+        self.parent.save()
+
+
+class BackupError(Exception):
+    def __init__(self, msg, **result):
+        super().__init__(msg)
+        self.result = result
+
+
+class GWSBackup(GWSClient):
+    def __init__(self, module, credentials=None, executor=None, checkpoint=None):
+        super().__init__(module, credentials, executor)
+        from google.cloud import storage
+
+        self.checkpoint = checkpoint if checkpoint is not None else Checkpoint()
+        self.verified_bytes = 0
+        self.verified_lock = threading.Lock()
+
+        self.storage_client_upload = storage.Client.from_service_account_json(
+            module.params["storage_creds_path"]
+        )
+
+    @property
+    def transfer_client(self):
+        return self.service("admin", "datatransfer_v1")
+
+    @property
+    def directory_client(self):
+        return self.service("admin", "directory_v1")
+
+    @property
+    def vault_client(self):
+        return self.service("vault", "v1")
+
+    @property
+    def storage_client_download(self):
+        return self.service("storage", "v1")
+
+    def get_user(self, email):
+        try:
+            user = self.execute(self.directory_client.users().get(userKey=email))
+            return user
+        except Exception as e:
+            raise BackupError(f"Failed to get user: {email}\n{e}")
+
+    def transfer_data(self, user, receiver):
+        # Every requested application is moved in a single transfer
+        applications = self.module.params["transfer_applications"]
+        try:
+            resp = self.execute(
+                self.transfer_client.transfers().insert(
+                    body={
+                        "oldOwnerUserId": user,
+                        "newOwnerUserId": receiver,
+                        "applicationDataTransfers": [
+                            TRANSFER_APPLICATIONS[application]
+                            for application in applications
+                        ],
+                    }
+                )
+            )
+            self.exit_messages.append(
+                f"Started transfer of {', '.join(applications)} data from {user} to {receiver}"
+            )
+            return resp
+        except Exception as e:
+            raise BackupError(f"Failed to transfer data from {user} to {receiver}\n{e}")
+
+    def get_transfer(self, transfer_id):
+        try:
+            return self.execute(
+                self.transfer_client.transfers().get(dataTransferId=transfer_id)
+            )
+        except Exception as e:
+            raise BackupError(f"Failed to get transfer {transfer_id}\n{e}")
+
+    def wait_for_transfers(self, transfer_ids, stop=None):
+        # Polls transfers until each one is completed or failed and returns them
+        # keyed by ID. Meant to run on its own thread while exports are polled;
+        # setting the stop event returns early with the transfers finished so far.
+        timeout = self.module.params["transfer_timeout"]
+        start = time.monotonic()
+        pending = set(transfer_ids)
+        finished = {}
+        interval = MIN_POLL_INTERVAL
+        while True:
+            for transfer_id in sorted(pending):
+                transfer = self.get_transfer(transfer_id)
+                status = transfer.get("overallTransferStatusCode")
+                if status not in ("completed", "failed"):
+                    continue
+                pending.discard(transfer_id)
+                finished[transfer_id] = transfer
+                self.exit_messages.append(
+                    f"Transfer {transfer_id} {status} after {time.monotonic() - start:.0f} seconds"
+                )
+            if not pending:
+                return finished
+
+            elapsed = time.monotonic() - start
+            if elapsed > timeout:
+                raise BackupError(
+                    f"Transfer took longer than {timeout} seconds to finish. Timing out.",
+                    transfer_ids=sorted(pending),
+                )
+            delay = min(interval, timeout - elapsed + MIN_POLL_INTERVAL)
+            if stop is None:
+                time.sleep(delay)
+            elif stop.wait(delay):
+                return finished
+            interval = min(interval * 1.5, MAX_POLL_INTERVAL)
+
+    def create_matter(self, matter_name, matter_owner):
+        try:
+            self.exit_messages.append(f"Creating matter named {matter_name}")
+            matter = self.execute(
+                self.vault_client.matters().create(
+                    body={
+                        "name": matter_name,
+                        "state": "OPEN",
+                        "matterPermissions": [
+                            {"accountId": matter_owner, "role": "OWNER"}
+                        ],
+                    }
+                )
+            )
+            self.exit_messages.append(f"Created matter {matter_name}")
+            return matter
+        except Exception as e:
+            raise BackupError(f"Failed to create matter {matter_name}\n{e}")
+
+    def create_export(self, user, matter_id, corpus="MAIL"):
+        query_options, export_options = EXPORT_OPTIONS[corpus]
+        try:
+            export = self.execute(
+                self.vault_client.matters()
+                .exports()
+                .create(
+                    matterId=matter_id,
+                    body={
+                        "name": f"{user.split('@')[0]} {corpus.lower()} export",
+                        "query": dict(
+                            query_options,
+                            corpus=corpus,
+                            dataScope="ALL_DATA",
+                            method="ACCOUNT",
+                            accountInfo={"emails": [user]},
+                        ),
+                        "exportOptions": export_options,
+                    },
+                )
+            )
+            self.exit_messages.append(f"Created {corpus.lower()} export for {user}")
+            return export
+        except Exception as e:
+            raise BackupError(
+                f"Failed to create {corpus.lower()} export for {user}\n{e}"
+            )
+
+    def get_export(self, matter_id, export_id):
+        try:
+            return self.execute(
+                self.vault_client.matters()
+                .exports()
+                .get(matterId=matter_id, exportId=export_id)
+            )
+        except Exception as e:
+            raise BackupError(f"Failed to get export {export_id}\n{e}")
+
+    def wait_for_exports(self, exports, start_next=None):
+        # Polls every running export in one loop and yields each one as soon as
+        # it is COMPLETED or FAILED. start_next, if given, is called after each
+        # one finishes and may return a newly created export to add to the loop.
+        # Polling starts fast and backs off, but never sleeps much past the
+        # remaining time estimated from an export's artifact counts.
+        timeout = self.module.params["export_timeout"]
+        running = {}
+        for export in exports:
+            running[export["id"]] = (export, time.monotonic())
+        interval = MIN_POLL_INTERVAL
+        while running:
+            for export_id, (export, started) in list(running.items()):
+                if export["status"] not in ("COMPLETED", "FAILED"):
+                    continue
+                del running[export_id]
+                self.exit_messages.append(
+                    f"Export {export_id} {export['status'].lower()} after {time.monotonic() - started:.0f} seconds"
+                )
+                yield export
+                next_export = start_next() if start_next else None
+                if next_export is not None:
+                    running[next_export["id"]] = (next_export, time.monotonic())
+            if not running:
+                break
+
+            interval = min(interval * 1.5, MAX_POLL_INTERVAL)
+            deadline = MAX_POLL_INTERVAL
+            for export_id, (export, started) in running.items():
+                elapsed = time.monotonic() - started
+                if elapsed > timeout:
+                    raise BackupError(
+                        f"Export took longer than {timeout} seconds to create. Timing out.",
+                        matter_id=export["matterId"],
+                        export_id=export_id,
+                        export_stats=export.get("stats", {}),
+                    )
+                deadline = min(deadline, timeout - elapsed + MIN_POLL_INTERVAL)
+                stats = export.get("stats", {})
+                exported = int(stats.get("exportedArtifactCount", 0))
+                total = int(stats.get("totalArtifactCount", 0))
+                if exported and total > exported and elapsed:
+                    remaining = (total - exported) / (exported / elapsed)
+                    interval = max(MIN_POLL_INTERVAL, min(interval, remaining))
+            time.sleep(min(interval, deadline))
+
+            for export_id, (export, started) in list(running.items()):
+                running[export_id] = (
+                    self.get_export(export["matterId"], export_id),
+                    started,
+                )
+
+    def object_checksums(self, bucket_name, object_name):
+        try:
+            return self.execute(
+                self.storage_client_download.objects().get(
+                    bucket=bucket_name,
+                    object=object_name,
+                    fields="size,md5Hash,crc32c",
+                )
+            )
+        except Exception as e:
+            raise BackupError(f"Failed to get metadata for {object_name}\n{e}")
+
+    def add_verified_bytes(self, size):
+        with self.verified_lock:
+            self.verified_bytes += size
+
+    def download_file(self, path, export_file):
+        # Downloads by byte range so that, with a checkpoint, a partial file left
+        # by an earlier run is resumed from where it stopped. The data is
+        # checksummed as it is written and checked against the object metadata.
+        bucket_name = export_file["bucketName"]
+        object_name = export_file["objectName"]
+        file_name = path + object_name.split("/")[-1]
+        expected = self.object_checksums(bucket_name, object_name)
+        size = int(expected["size"])
+        chunk_size = self.module.params["download_chunk_size"]
+        checksum = Checksum()
+        start = time.monotonic()
+
+        offset = 0
+        if self.checkpoint.path and os.path.isfile(file_name):
+            offset = min(os.path.getsize(file_name), size)
+        resumed = offset
+        with open(file_name, "r+b" if offset else "wb") as out_file:
+            # Only the part kept from an earlier run is read back to hash it
+            while out_file.tell() < offset:
+                remaining = offset - out_file.tell()
+                checksum.update(out_file.read(min(chunk_size, remaining)))
+            out_file.truncate()
+            while offset < size:
+                req = self.storage_client_download.objects().get_media(
+                    bucket=bucket_name, object=object_name
+                )
+                req.headers["range"] = (
+                    f"bytes={offset}-{min(offset + chunk_size, size) - 1}"
+                )
+                content = self.execute(req)
+                if not content:
+                    raise BackupError(
+                        f"Download of {object_name} stopped at {offset} of {size} bytes"
+                    )
+                out_file.write(content)
+                checksum.update(content)
+                offset += len(content)
+
+        checksums = checksum.encoded()
+        verify_checksums(object_name, expected, checksums)
+        self.add_verified_bytes(size)
+        self.checkpoint.record_file(
+            object_name, name=os.path.basename(file_name), **checksums
+        )
+        return file_name, size - resumed, time.monotonic() - start
+
+    def download_files(self, path, export_files):
+        # Each worker thread downloads on its own storage client
+        start = time.monotonic()
+        total_bytes = 0
+        downloaded = self.checkpoint.get("files", {})
+        export_files = [
+            export_file
+            for export_file in export_files
+            if export_file["objectName"] not in downloaded
+        ]
+        with ThreadPoolExecutor(
+            max_workers=max(1, self.module.params["download_workers"])
+        ) as pool:
+            futures = [
+                pool.submit(self.download_file, path, export_file)
+                for export_file in export_files
+            ]
+            for export_file, future in zip(export_files, futures):
+                object_name = export_file["objectName"]
+                try:
+                    file_name, size, seconds = future.result()
+                except Exception as e:
+                    for pending in futures:
+                        pending.cancel()
+                    raise BackupError(f"Failed to download file: {object_name}\n{e}")
+                total_bytes += size
+                self.exit_messages.append(
+                    f"Downloaded file: {object_name} to {file_name} "
+                    f"({size} bytes at {size / max(seconds, 0.001):.0f} bytes/s)"
+                )
+        return transfer_stats(len(export_files), total_bytes, start)
+
+    def stream_archive(self, user, export_files, bucket_name):
+        # Export objects are read chunk by chunk straight into a zip entry, and
+        # the zip is written to a resumable upload, so memory use is bounded by
+        # the chunk sizes and nothing is staged on local disk. Each entry and
+        # the zip itself are checksummed on the way through.
+        import googleapiclient.http
+
+        archive_format = self.module.params["archive_format"]
+        if archive_format not in ("zip_stored", "zip_deflate"):
+            raise BackupError(
+                f"archive_format {archive_format} is not supported when streaming"
+            )
+        compression = zipfile.ZIP_DEFLATED
+        if archive_format == "zip_stored":
+            compression = zipfile.ZIP_STORED
+        archive_name = self.archive_name(user)
+        start = time.monotonic()
+        total_bytes = 0
+        manifest = []
+        blob = self.storage_client_upload.bucket(bucket_name).blob(archive_name)
+        try:
+            with blob.open(
+                "wb", chunk_size=self.module.params["upload_chunk_size"]
+            ) as upload:
+                archive = ChecksumWriter(upload)
+                with zipfile.ZipFile(
+                    archive, "w", compression, compresslevel=self.compression_level()
+                ) as zipf:
+                    for export_file in export_files:
+                        object_name = export_file["objectName"]
+                        name = object_name.split("/")[-1]
+                        expected = self.object_checksums(
+                            export_file["bucketName"], object_name
+                        )
+                        req = self.storage_client_download.objects().get_media(
+                            bucket=export_file["bucketName"], object=object_name
+                        )
+                        with zipf.open(name, "w", force_zip64=True) as entry:
+                            writer = ChecksumWriter(entry)
+                            downloader = googleapiclient.http.MediaIoBaseDownload(
+                                writer,
+                                req,
+                                chunksize=self.module.params["download_chunk_size"],
+                            )
+                            done = False
+                            while not done:
+                                status, done = downloader.next_chunk(
+                                    num_retries=self.module.params["api_max_retries"]
+                                )
+                        checksums = writer.checksum.encoded()
+                        verify_checksums(object_name, expected, checksums)
+                        self.add_verified_bytes(checksums["size"])
+                        manifest.append(dict(name=name, **checksums))
+                        total_bytes += checksums["size"]
+                        self.exit_messages.append(
+                            f"Streamed file: {object_name} into {archive_name}"
+                        )
+                    zipf.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+            self.verify_upload(blob, archive.checksum.encoded())
+            self.exit_messages.append(f"Uploaded {archive_name} to {bucket_name}")
+        except Exception as e:
+            raise BackupError(f"Failed to stream {archive_name} to {bucket_name}\n{e}")
+        return dict(
+            transfer_stats(len(export_files), total_bytes, start),
+            verified_bytes=self.verified_bytes,
+        )
+
+    def server_side_archive(self, user, export_files, bucket_name):
+        # Export objects are rewritten into {user}/ in the archive bucket by GCS
+        # itself, so no mailbox bytes pass through the runner. Large or
+        # cross-location copies take several rewrite calls.
+        import googleapiclient.http
+
+        objects = self.storage_client_download.objects()
+        parts = []
+        try:
+            for export_file in export_files:
+                source = export_file["objectName"]
+                destination = f"{user}/{source.split('/')[-1]}"
+                rewrite_token = None
+                while True:
+                    resp = self.execute(
+                        objects.rewrite(
+                            sourceBucket=export_file["bucketName"],
+                            sourceObject=source,
+                            destinationBucket=bucket_name,
+                            destinationObject=destination,
+                            rewriteToken=rewrite_token,
+                            body={},
+                        )
+                    )
+                    if resp["done"]:
+                        break
+                    rewrite_token = resp["rewriteToken"]
+                # GCS checksums the copy itself; compare it with the source
+                verify_checksums(
+                    destination,
+                    self.object_checksums(export_file["bucketName"], source),
+                    resp["resource"],
+                )
+                self.add_verified_bytes(int(resp["resource"]["size"]))
+                parts.append(
+                    {
+                        "name": destination,
+                        "source": f"gs://{export_file['bucketName']}/{source}",
+                        "size": int(resp["resource"]["size"]),
+                        "md5Hash": resp["resource"].get("md5Hash"),
+                        "crc32c": resp["resource"].get("crc32c"),
+                    }
+                )
+                self.exit_messages.append(
+                    f"Copied file: {source} to {bucket_name}/{destination}"
+                )
+
+            manifest = {"user": user, "parts": parts}
+            self.execute(
+                objects.insert(
+                    bucket=bucket_name,
+                    name=f"{user}/manifest.json",
+                    media_body=googleapiclient.http.MediaInMemoryUpload(
+                        json.dumps(manifest, indent=2).encode(),
+                        mimetype="application/json",
+                    ),
+                )
+            )
+            self.exit_messages.append(
+                f"Wrote manifest of {len(parts)} files to {bucket_name}/{user}/manifest.json"
+            )
+        except Exception as e:
+            raise BackupError(f"Failed to copy export for {user} to {bucket_name}\n{e}")
+        return {"verified_bytes": self.verified_bytes}
+
+    def archive_name(self, user):
+        return f"{user}.{ARCHIVE_EXTENSIONS[self.module.params['archive_format']]}"
+
+    def compression_level(self):
+        level = self.module.params["compression_level"]
+        if level is None:
+            level = DEFAULT_COMPRESSION_LEVELS[self.module.params["archive_format"]]
+        return level
+
+    def archive_files(self, path, user):
+        # The archive is checksummed as it is written, for comparison with the
+        # uploaded object, and carries a manifest of the downloaded files
+        archive_format = self.module.params["archive_format"]
+        archive_name = self.archive_name(user)
+        manifest = sorted(
+            self.checkpoint.get("files", {}).values(), key=lambda f: f["name"]
+        )
+        level = self.compression_level()
+        workers = self.module.params["compression_workers"] or os.cpu_count() or 1
+        start = time.monotonic()
+        try:
+            files = [
+                f
+                for f in os.listdir(path)
+                if os.path.isfile(os.path.join(path, f)) and f != archive_name
+            ]
+            input_bytes = sum(os.path.getsize(os.path.join(path, f)) for f in files)
+            with open(f"{path}{archive_name}", "wb") as out_file:
+                archive = ChecksumWriter(out_file)
+                if archive_format == "tar_zstd":
+                    write_tar_zstd(archive, path, files, manifest, level, workers)
+                elif archive_format == "tar_xz":
+                    write_tar_xz(archive, path, files, manifest, level, workers)
+                else:
+                    write_zip(
+                        archive, path, files, manifest, archive_format, level, workers
+                    )
+        except BackupError:
+            raise
+        except Exception as e:
+            raise BackupError(f"Failed to archive files in {path}\n{e}")
+        checksums = archive.checksum.encoded()
+        self.checkpoint.update(archive=checksums)
+        self.exit_messages.append(f"Archived files in {path} to {path}{archive_name}")
+        return compression_stats(input_bytes, checksums["size"], start)
+
+    def upload_archive(self, path, user, bucket_name):
+        # Uploads through a resumable session whose URI is checkpointed, so a
+        # rerun only sends the bytes GCS has not yet received
+        import requests
+
+        archive_name = self.archive_name(user)
+        file_name = f"{path}{archive_name}"
+        size = os.path.getsize(file_name)
+        chunk_size = self.module.params["upload_chunk_size"]
+        session = requests.Session()
+        try:
+            session_uri = self.checkpoint.get("upload_session_uri")
+            offset = None
+            if session_uri:
+                offset = self.upload_offset(session, session_uri, size)
+            if offset is None:
+                session_uri = (
+                    self.storage_client_upload.bucket(bucket_name)
+                    .blob(archive_name)
+                    .create_resumable_upload_session(size=size)
+                )
+                self.checkpoint.update(upload_session_uri=session_uri)
+                offset = 0
+
+            with open(file_name, "rb") as f:
+                while offset < size:
+                    f.seek(offset)
+                    data = f.read(chunk_size)
+                    resp = session.put(
+                        session_uri,
+                        data=data,
+                        headers={
+                            "Content-Range": f"bytes {offset}-{offset + len(data) - 1}/{size}"
+                        },
+                    )
+                    if resp.status_code in (200, 201):
+                        offset = size
+                    elif resp.status_code == 308:
+                        offset = next_upload_offset(resp)
+                    else:
+                        resp.raise_for_status()
+            self.verify_upload(
+                self.storage_client_upload.bucket(bucket_name).blob(archive_name),
+                self.checkpoint.get("archive"),
+            )
+            self.exit_messages.append(f"Uploaded {archive_name} to {bucket_name}")
+        except Exception as e:
+            raise BackupError(f"Failed to upload {archive_name} to {bucket_name}\n{e}")
+
+    def upload_offset(self, session, session_uri, size):
+        # Returns how many bytes an existing upload session has persisted, or
+        # None when the session has expired and a new one is needed
+        resp = session.put(session_uri, headers={"Content-Range": f"bytes */{size}"})
+        if resp.status_code in (200, 201):
+            return size
+        if resp.status_code == 308:
+            return next_upload_offset(resp)
+        if resp.status_code in (404, 410):
+            return None
+        resp.raise_for_status()
+
+    def verify_upload(self, blob, checksums):
+        blob.reload()
+        verify_checksums(
+            blob.name,
+            checksums,
+            {"size": blob.size, "md5Hash": blob.md5_hash, "crc32c": blob.crc32c},
+        )
+        self.add_verified_bytes(blob.size)
+
+    def delete_files(self, path):
+        files_and_directories = os.listdir(path)
+        files = [
+            f for f in files_and_directories if os.path.isfile(os.path.join(path, f))
+        ]
+        for file_name in files:
+            os.remove(os.path.join(path, file_name))
+        self.exit_messages.append(f"Deleted files in {path}")
+
+    def archive_export(self, user, export, path, bucket_name):
+        # Returns download stats for the archive modes that move bytes locally
+        export_files = export["cloudStorageSink"]["files"]
+        archive_mode = self.module.params["archive_mode"]
+        if archive_mode == "stream":
+            return self.stream_archive(user, export_files, bucket_name)
+        if archive_mode == "server_side":
+            return self.server_side_archive(user, export_files, bucket_name)
+
+        # Download, archive export files, upload to bucket, clean up files.
+        # Stages already finished by an earlier run are skipped.
+        download_stats = {}
+        stage = self.checkpoint.get("stage")
+        if stage not in ("archived", "uploaded"):
+            download_stats = self.download_files(path, export_files)
+            self.checkpoint.update(
+                compression_stats=self.archive_files(path, user), stage="archived"
+            )
+        if stage != "uploaded":
+            self.upload_archive(path, user, bucket_name)
+            self.checkpoint.update(stage="uploaded")
+        self.delete_files(path)
+        return dict(
+            download_stats,
+            verified_bytes=self.verified_bytes,
+            compression_stats=self.checkpoint.get("compression_stats"),
+        )
@@ -0,0 +1,132 @@
+MEMBER_ROLES = ("MEMBER", "MANAGER", "OWNER")
+
+ADD = "add"
+UPDATE = "update"
+REMOVE = "remove"
+
+
+def normalize_email(email):
+    # Workspace addresses are case-insensitive; compare them in one form only
+    return email.strip().lower()
+
+
+class MemberChange:
+    __slots__ = ("operation", "email", "role", "current_role")
+
+    def __init__(self, operation, email, role=None, current_role=None):
+        self.operation = operation
+        self.email = email
+        self.role = role
+        self.current_role = current_role
+
+    def record(self, client, group_email):
+        before = None if self.current_role is None else {"role": self.current_role}
+        after = None if self.role is None else {"role": self.role}
+        client.record_change(
+            self.operation, f"group/{group_email}/member/{self.email}", before, after
+        )
+
+
+def desired_members(members):
+    # Validates declared members and returns their roles keyed by normalized
+    # email. Raises ValueError naming the first invalid member.
+    desired = {}
+    for member in members or []:
+        email = member.get("email", "")
+        role = member.get("role")
+        if "@" not in email:
+            raise ValueError(f"Need valid email for member. Given: {email}")
+        if role not in MEMBER_ROLES:
+            raise ValueError(f"Need valid role for member. Given: {role}")
+        desired[normalize_email(email)] = role
+    return desired
+
+
+def diff_members(desired, actual):
+    # Both arguments map normalized email to role. Membership is compared with
+    # set operations on the key views, and only common keys have roles compared.
+    # Changes come out grouped by operation and sorted by email.
+    plan = [
+        MemberChange(ADD, email, desired[email])
+        for email in sorted(desired.keys() - actual.keys())
+    ]
+    updated = [
+        email
+        for email in desired.keys() & actual.keys()
+        if desired[email] != actual[email]
+    ]
+    plan.extend(
+        MemberChange(UPDATE, email, desired[email], actual[email])
+        for email in sorted(updated)
+    )
+    plan.extend(
+        MemberChange(REMOVE, email, current_role=actual[email])
+        for email in sorted(actual.keys() - desired.keys())
+    )
+    return plan
+
+
+def apply_member_plan(client, group_email, plan, check_mode):
+    # client provides create_group_member, update_group_member and
+    # delete_group_member; in check mode the plan is only recorded
+    for change in plan:
+        change.record(client, group_email)
+        if check_mode:
+            continue
+        if change.operation == ADD:
+            client.create_group_member(group_email, change.email, change.role)
+        elif change.operation == UPDATE:
+            client.update_group_member(group_email, change.email, change.role)
+        else:
+            client.delete_group_member(group_email, change.email)
+
+
+# User fields read for reconciliation; everything else is left out of responses
+USER_FIELDS = (
+    "id,etag,primaryEmail,aliases,isAdmin,suspended,orgUnitPath,"
+    "name(givenName,familyName)"
+)
+
+
+def user_attributes(given_name, surname, suspended, org_unit_path=None, aliases=None):
+    # Declared attributes in API form. Attributes left as None are unmanaged.
+    # Admin status and roles are reconciled separately, see module_utils/admin.py.
+    attributes = {
+        "name": {"givenName": given_name, "familyName": surname},
+        "suspended": suspended,
+    }
+    if org_unit_path is not None:
+        attributes["orgUnitPath"] = org_unit_path
+    if aliases is not None:
+        attributes["aliases"] = sorted({normalize_email(a) for a in aliases})
+    return attributes
+
+
+def diff_user(desired, current):
+    # Returns the before and after values of only the attributes that differ,
+    # compared field by field, so after can be sent as the patch body. Aliases
+    # are not part of the user resource and are diffed by diff_aliases.
+    before = {}
+    after = {}
+    for key, value in desired.items():
+        if key == "aliases":
+            continue
+        if key == "name":
+            current_name = current.get("name", {})
+            changed = {k: v for k, v in value.items() if current_name.get(k) != v}
+            if changed:
+                before["name"] = {k: current_name.get(k) for k in changed}
+                after["name"] = changed
+        elif current.get(key) != value:
+            before[key] = current.get(key)
+            after[key] = value
+    return before, after
+
+
+def diff_aliases(desired, current):
+    # Returns the aliases to add and to remove, or nothing when unmanaged
+    if "aliases" not in desired:
+        return [], []
+    wanted = set(desired["aliases"])
+    existing = {normalize_email(a) for a in current.get("aliases", [])}
+    return sorted(wanted - existing), sorted(existing - wanted)
@@ -0,0 +1,77 @@
+import json
+import os
+import tempfile
+import threading
+
+DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/{api}/{version}/rest"
+
+# Parsed discovery documents, shared by every thread in the process
+documents = {}
+documents_lock = threading.Lock()
+
+
+def read_cached_document(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_cached_document(path, document):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(document, f)
+    os.replace(tmp_path, path)
+
+
+def fetch_document(name, version):
+    import httplib2
+
+    resp, content = httplib2.Http().request(
+        DISCOVERY_URL.format(api=name, version=version)
+    )
+    if resp.status >= 400:
+        raise RuntimeError(
+            f"Failed to fetch discovery document for {name} {version}: {resp.status}"
+        )
+    return json.loads(content)
+
+
+def load_document(name, version, cache_dir=None):
+    # Lookup order: in-process memo, on-disk cache, documents bundled with
+    # googleapiclient, and only then the discovery service itself
+    key = (name, version)
+    with documents_lock:
+        if key in documents:
+            return documents[key]
+
+    path = None
+    document = None
+    if cache_dir:
+        path = os.path.join(os.path.expanduser(cache_dir), f"{name}.{version}.json")
+        document = read_cached_document(path)
+
+    if document is None:
+        from googleapiclient.discovery_cache import get_static_doc
+
+        static_document = get_static_doc(name, version)
+        if static_document is not None:
+            document = json.loads(static_document)
+
+    if document is None:
+        document = fetch_document(name, version)
+        if path:
+            write_cached_document(path, document)
+
+    with documents_lock:
+        documents[key] = document
+    return document
+
+
+def build_service(name, version, http, cache_dir=None):
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(load_document(name, version, cache_dir), http=http)
@@ -0,0 +1,270 @@
+import json
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+from ansible_collections.striveworks.gws.plugins.module_utils.auth import (
+    authorized_http,
+    get_credentials,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.diff import (
+    normalize_email,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.discovery import (
+    build_service,
+)
+
+# Admin SDK accepts at most 1000 calls in a single batch request
+BATCH_SIZE = 1000
+
+# Directory API default quota is 2,400 queries per minute per user
+DEFAULT_QPS = 40
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+RETRYABLE_REASONS = (
+    "userRateLimitExceeded",
+    "rateLimitExceeded",
+    "quotaExceeded",
+    "backendError",
+)
+
+
+def gws_argument_spec():
+    return {
+        "auth_email": {"type": "str", "required": True},
+        "auth_scopes": {"type": "list", "required": True},
+        "auth_dictionary": {"type": "dict", "required": True},
+        "api_qps": {"type": "float", "default": DEFAULT_QPS},
+        "api_max_retries": {"type": "int", "default": 5},
+        "discovery_cache_dir": {"type": "path", "required": False},
+        "token_cache_path": {"type": "path", "required": False, "no_log": False},
+        # Write planned changes here as JSON Lines and return only their counts
+        "plan_path": {"type": "path", "required": False},
+    }
+
+
+def is_retryable(error):
+    if not isinstance(error, HttpError):
+        return False
+    status = int(error.resp.status)
+    if status in RETRYABLE_STATUSES:
+        return True
+    if status != 403:
+        return False
+    try:
+        errors = json.loads(error.content)["error"].get("errors", [])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+    return any(e.get("reason") in RETRYABLE_REASONS for e in errors)
+
+
+class RateLimiter:
+    # Token bucket holding up to one second of requests. Callers reserve tokens
+    # under the lock and sleep outside it, so concurrent callers queue fairly.
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RequestExecutor:
+    def __init__(self, qps=DEFAULT_QPS, max_retries=5, base_delay=1, max_delay=64):
+        self.limiter = RateLimiter(qps)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.throttle_wait = 0.0
+        self.backoff_wait = 0.0
+
+    def throttle(self, cost=1):
+        waited = self.limiter.acquire(cost)
+        with self.lock:
+            self.requests += cost
+            self.throttle_wait += waited
+
+    def backoff(self, attempt, retries=1):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        with self.lock:
+            self.retries += retries
+            self.backoff_wait += delay
+        time.sleep(delay)
+
+    def execute(self, request, cost=1):
+        attempt = 0
+        while True:
+            self.throttle(cost)
+            try:
+                return request.execute()
+            except HttpError as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                self.backoff(attempt)
+                attempt += 1
+
+    def execute_batch(self, client, requests, callback):
+        # Sends requests as batch HTTP requests and calls callback(index, response,
+        # exception) once per request. Sub-requests failing with a retryable error
+        # are resubmitted in a later batch after backing off.
+        pending = list(range(len(requests)))
+        attempt = 0
+        while pending:
+            retry = []
+
+            def batch_callback(request_id, response, exception):
+                index = int(request_id)
+                if (
+                    exception is not None
+                    and attempt < self.max_retries
+                    and is_retryable(exception)
+                ):
+                    retry.append(index)
+                else:
+                    callback(index, response, exception)
+
+            for start in range(0, len(pending), BATCH_SIZE):
+                chunk = pending[start : start + BATCH_SIZE]
+                batch = client.new_batch_http_request(callback=batch_callback)
+                for index in chunk:
+                    batch.add(requests[index], request_id=str(index))
+                self.execute(batch, cost=len(chunk))
+
+            if retry:
+                self.backoff(attempt, len(retry))
+                attempt += 1
+            pending = sorted(retry)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "throttle_wait_seconds": round(self.throttle_wait, 3),
+                "backoff_wait_seconds": round(self.backoff_wait, 3),
+            }
+
+
+# googleapiclient service objects are not thread-safe, so every thread builds
+# its own clients on its own httplib2 connection
+thread_local = threading.local()
+
+
+class GWSClient:
+    def __init__(self, module, credentials=None, executor=None):
+        if credentials is None:
+            credentials = get_credentials(module)
+        if executor is None:
+            executor = RequestExecutor(
+                module.params["api_qps"], module.params["api_max_retries"]
+            )
+        self.credentials = credentials
+        self.executor = executor
+        self.module = module
+        self.exit_messages = []
+        self.changes = []
+
+    def service(self, name, version):
+        if not hasattr(thread_local, "services"):
+            thread_local.services = {}
+        key = (id(self.credentials), name, version)
+        if key not in thread_local.services:
+            thread_local.services[key] = build_service(
+                name,
+                version,
+                http=authorized_http(self.credentials),
+                cache_dir=self.module.params.get("discovery_cache_dir"),
+            )
+        return thread_local.services[key]
+
+    @property
+    def client(self):
+        return self.service("admin", "directory_v1")
+
+    def execute(self, request):
+        return self.executor.execute(request)
+
+    def paginate(self, method, items_key="items", **kwargs):
+        # Yields the items of every page of a list request. method is the
+        # resource's list method, called again with each page's token. API
+        # errors are raised for the caller to report.
+        page_token = None
+        while True:
+            page = self.execute(method(pageToken=page_token, **kwargs))
+            yield from page.get(items_key, [])
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                break
+
+    def list_group_members(self, email):
+        return self.paginate(
+            self.client.members().list,
+            "members",
+            groupKey=email,
+            maxResults=200,
+            fields="members(email,role),nextPageToken",
+        )
+
+    def get_group_members(self, email):
+        # Maps normalized member email to role
+        group_members = {}
+        for member in self.list_group_members(email):
+            # Members such as the whole customer have no email address
+            if "email" in member:
+                group_members[normalize_email(member["email"])] = member["role"]
+        return group_members
+
+    def record_change(self, operation, resource, before=None, after=None):
+        # Changes are recorded as planned, in check mode and when applied alike
+        self.changes.append(
+            {
+                "operation": operation,
+                "resource": resource,
+                "before": before,
+                "after": after,
+            }
+        )
+
+    def result(self, **result):
+        # Keyword arguments for exit_json/fail_json. The plan goes in the result
+        # as changes, or to plan_path when set so large plans stay out of it.
+        counts = {}
+        for change in self.changes:
+            counts[change["operation"]] = counts.get(change["operation"], 0) + 1
+        messages = list(self.exit_messages)
+        if self.module.check_mode and counts:
+            summary = ", ".join(f"{count} {op}" for op, count in sorted(counts.items()))
+            messages.append(f"Would have made changes: {summary}")
+
+        plan_path = self.module.params.get("plan_path")
+        if plan_path:
+            with open(plan_path, "w") as f:
+                for change in self.changes:
+                    f.write(json.dumps(change) + "\n")
+            result["plan_path"] = plan_path
+        else:
+            result["changes"] = self.changes
+        return dict(
+            result,
+            changed=bool(self.exit_messages or self.changes),
+            msg="\n".join(messages),
+            change_counts=counts,
+            api_stats=self.executor.stats(),
+        )
+
+    def execute_batch(self, requests, callback):
+        self.executor.execute_batch(self.client, requests, callback)
@@ -0,0 +1,159 @@
+import copy
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+def state_argument_spec():
+    return {
+        # JSON file remembering what each declaration last looked like once
+        # applied, so unchanged declarations can be skipped on later runs
+        "state_cache_path": {"type": "path", "required": False},
+        # Entries older than this are checked against the API again even when
+        # their declaration is unchanged, to pick up changes made elsewhere
+        "state_cache_max_age": {"type": "int", "default": 86400},
+    }
+
+
+def desired_hash(declaration, exclude=()):
+    declaration = {k: v for k, v in declaration.items() if k not in exclude}
+    data = json.dumps(declaration, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class StateCache:
+    # Per resource: the hash of the declaration last applied, the etag the
+    # resource had once in sync, the in-sync state itself where it's small, and
+    # when it was last checked. feed holds the change feed's cursor and watch
+    # channels. Without a path nothing is cached.
+    def __init__(self, path=None, max_age=86400):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries, self.feed = self.read()
+        # What this run changed, merged into the file as it is when saved
+        self.updated = set()
+        self.dirtied = {}
+        self.loaded()
+
+    def read(self):
+        if not self.path or not os.path.isfile(self.path):
+            return {}, {}
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return data.get("entries", {}), data.get("feed", {})
+        except (ValueError, AttributeError):
+            return {}, {}
+
+    def loaded(self):
+        # Dirty marks and feed values as last read, to tell changes made by
+        # other runs since then from this run's own
+        self.loaded_dirty = {
+            resource: entry.get("dirty") for resource, entry in self.entries.items()
+        }
+        self.loaded_feed = copy.deepcopy(self.feed)
+
+    def get(self, resource):
+        with self.lock:
+            return self.entries.get(resource)
+
+    def matches(self, resource, digest):
+        # The declaration is the one last applied, whatever the entry's age
+        entry = self.get(resource)
+        return entry is not None and entry["hash"] == digest
+
+    def is_fresh(self, resource, digest):
+        # Unchanged declarations checked recently are skipped without a request
+        entry = self.get(resource)
+        return (
+            entry is not None
+            and entry["hash"] == digest
+            and not entry.get("dirty")
+            and time.time() - entry["checked"] < self.max_age
+        )
+
+    def is_dirty(self, resource):
+        # Marked by the change feed since the resource was last checked
+        entry = self.get(resource)
+        return entry is not None and bool(entry.get("dirty"))
+
+    def mark_dirty(self, resource, changed_at=None):
+        # Called for resources changed out-of-band at changed_at, or now.
+        # Entries checked since then already saw the change and are left
+        # alone, as are resources that aren't cached: they're reconciled in full
+        # anyway, unless another run caches them before this one saves. Returns
+        # whether the entry was marked. The mark is the time of the change, so
+        # concurrent runs can tell marks apart.
+        with self.lock:
+            mark = time.time() if changed_at is None else changed_at
+            self.dirtied[resource] = max(mark, self.dirtied.get(resource, mark))
+            entry = self.entries.get(resource)
+            if entry is None or entry["checked"] >= mark:
+                return False
+            entry["dirty"] = max(mark, entry.get("dirty") or mark)
+            return True
+
+    def update(self, resource, digest, etag=None, state=None):
+        with self.lock:
+            self.entries[resource] = {
+                "hash": digest,
+                "etag": etag,
+                "state": state,
+                "checked": time.time(),
+            }
+            self.updated.add(resource)
+
+    def merge(self, entries, feed):
+        # Applies this run's changes on top of the file's current contents.
+        # Entries this run didn't touch keep whatever other runs saved, and a
+        # dirty mark made after this run loaded the file survives its update.
+        for resource in self.updated:
+            entry = dict(self.entries[resource])
+            current = entries.get(resource) or {}
+            if current.get("dirty") and current["dirty"] != self.loaded_dirty.get(
+                resource
+            ):
+                entry["dirty"] = current["dirty"]
+            entries[resource] = entry
+        for resource, mark in self.dirtied.items():
+            entry = entries.get(resource)
+            if entry is None or resource in self.updated or entry["checked"] >= mark:
+                continue
+            entry["dirty"] = max(mark, entry.get("dirty") or mark)
+        for key in self.feed.keys() | self.loaded_feed.keys():
+            if self.feed.get(key) == self.loaded_feed.get(key):
+                continue
+            if key in self.feed:
+                feed[key] = self.feed[key]
+            else:
+                feed.pop(key, None)
+
+    def save(self):
+        # The read-modify-write runs under an exclusive lock on a file beside
+        # the cache, as the cache itself is replaced rather than rewritten
+        if not self.path:
+            return
+        with self.lock:
+            fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+            with os.fdopen(fd, "r+") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    entries, feed = self.read()
+                    self.merge(entries, feed)
+                    directory = os.path.dirname(os.path.abspath(self.path))
+                    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+                    with os.fdopen(fd, "w") as f:
+                        json.dump({"entries": entries, "feed": feed}, f)
+                    os.replace(tmp_path, self.path)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self.entries = entries
+            self.feed = feed
+            self.updated = set()
+            self.dirtied = {}
+            self.loaded()
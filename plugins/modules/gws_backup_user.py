@@ -6,246 +6,247 @@
 #         else:
 #             # archive user or fail
 #             module.fail_json(msg=f"User: {email} not archived")
-import io
 import os
-import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from ansible.module_utils.basic import AnsibleModule
-from googleapiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
-import time
-from google.cloud import storage
-import googleapiclient.http
-import zipfile
-
+from ansible_collections.striveworks.gws.plugins.module_utils.backup import (
+    BackupError,
+    EXPORT_OPTIONS,
+    Checkpoint,
+    GWSBackup,
+    backup_argument_spec,
+)
 
 DOCUMENTATION = """
 ---
 module: gws_backup_user
 short_description: Backup Google Workspace user
 description: Delete google workspace user
+requirements:
+  - google-crc32c, optional, to verify files and archives with CRC32C as well as MD5
+  - zstandard, for archive_format tar_zstd
 author: "Will Albers (@walbers)"
 """
 
 
-class AnsibleGWS:
-    def __init__(self, module):
-        credentials = ServiceAccountCredentials.from_json_keyfile_dict(
-            module.params["auth_dictionary"], scopes=module.params["auth_scopes"]
-        )
-        credentials = credentials.create_delegated(module.params["auth_email"])
-        self.transfer_client = build(
-            "admin", "datatransfer_v1", credentials=credentials
-        )
-        self.directory_client = build("admin", "directory_v1", credentials=credentials)
-        self.vault_client = build("vault", "v1", credentials=credentials)
-        self.storage_client_download = build("storage", "v1", credentials=credentials)
-        self.storage_client_upload = storage.Client.from_service_account_json(
-            module.params["storage_creds_path"]
-        )
-        self.module = module
-        self.exit_messages = []
-
-    def get_user(self, email):
-        try:
-            user = self.directory_client.users().get(userKey=email).execute()
-            return user
-        except Exception as e:
-            self.module.fail_json(msg=f"Failed to get user: {email}\n{e}")
-
-    def transfer_data(self, user, receiver):
-        try:
-            resp = (
-                self.transfer_client.transfers()
-                .insert(
-                    body={
-                        "oldOwnerUserId": user,
-                        "newOwnerUserId": receiver,
-                        "applicationDataTransfers": [
-                            {
-                                "applicationId": "55656082996",
-                                "applicationTransferParams": [
-                                    {
-                                        "key": "PRIVACY_LEVEL",
-                                        "value": ["PRIVATE", "SHARED"],
-                                    }
-                                ],
-                            }
-                        ],
-                    }
-                )
-                .execute()
-            )
-            self.exit_messages.append(f"Transferred data from {user} to {receiver}")
-        except Exception as e:
-            self.module.fail_json(
-                msg=f"Failed to transfer data from {user} to {receiver}\n{e}"
-            )
-
-    def create_matter(self, user, matter_owner):
-        try:
-            matter_name = user.split("@")[0] + " export matter"
-            self.exit_messages.append(f"Creating matter named {matter_name}")
-            matter = (
-                self.vault_client.matters()
-                .create(
-                    body={
-                        "name": matter_name,
-                        "state": "OPEN",
-                        "matterPermissions": [
-                            {"accountId": matter_owner, "role": "OWNER"}
-                        ],
-                    }
-                )
-                .execute()
-            )
-            self.exit_messages.append(f"Created matter for {user}")
-            return matter
-        except Exception as e:
-            self.module.fail_json(msg=f"Failed to create matter for {user}\n{e}")
-
-    def create_mail_export(self, user, matter_id, bucket_name):
-        try:
-            matter_name = user.split("@")[0] + " export matter"
-            export = (
-                self.vault_client.matters()
-                .exports()
-                .create(
-                    matterId=matter_id,
-                    body={
-                        "name": matter_name,
-                        "query": {
-                            "corpus": "MAIL",
-                            "dataScope": "ALL_DATA",
-                            "method": "ACCOUNT",
-                            "accountInfo": {"emails": [user]},
-                            "mailOptions": {"excludeDrafts": False},
-                        },
-                        "exportOptions": {
-                            "mailOptions": {
-                                "exportFormat": "MBOX",
-                                "showConfidentialModeContent": True,
-                                "useNewExport": True,
-                            }
-                        },
-                    },
-                )
-                .execute()
-            )
-            self.exit_messages.append(f"Created mail export for {user}")
-            return export
-        except Exception as e:
-            self.module.fail_json(msg=f"Failed to create export for {user}\n{e}")
-
-    def download_file(self, path, bucket_name, object_name):
-        req = self.storage_client_download.objects().get_media(
-            bucket=bucket_name, object=object_name
-        )
-        file_name = path + object_name.split("/")[-1]
-        try:
-            with io.FileIO(file_name, mode="wb") as out_file:
-                downloader = googleapiclient.http.MediaIoBaseDownload(out_file, req)
-                done = False
-                while not done:
-                    status, done = downloader.next_chunk()
-                    time.sleep(5)
-            self.exit_messages.append(f"Downloaded file: {object_name} to {file_name}")
-        except Exception as e:
-            self.module.fail_json(msg=f"Failed to download file: {object_name}\n{e}")
-
-    def zip_files(self, path, user):
-        files_and_directories = os.listdir(path)
-        files = [
-            f for f in files_and_directories if os.path.isfile(os.path.join(path, f))
-        ]
-        with zipfile.ZipFile(f"{path}{user}.zip", "w", zipfile.ZIP_DEFLATED) as zipf:
-            for file_name in files:
-                temp = zipf.write(os.path.join(path, file_name), file_name)
-        self.exit_messages.append(f"Zipped files in {path} to {path}{user}.zip")
-
-    def upload_zip(self, path, user, bucket_name):
-        try:
-            self.storage_client_upload.bucket(bucket_name).blob(
-                f"{user}.zip"
-            ).upload_from_filename(f"{path}{user}.zip")
-            self.exit_messages.append(f"Uploaded {user}.zip to {bucket_name}")
-        except Exception as e:
-            self.module.fail_json(
-                msg=f"Failed to upload {user}.zip to {bucket_name}\n{e}"
-            )
-
-    def delete_files(self, path):
-        files_and_directories = os.listdir(path)
-        files = [
-            f for f in files_and_directories if os.path.isfile(os.path.join(path, f))
-        ]
-        for file_name in files:
-            os.remove(os.path.join(path, file_name))
-        self.exit_messages.append(f"Deleted files in {path}")
-
-
 def main():
 
-    argument_spec = {
-        "auth_email": {"type": "str", "required": True},
-        "auth_scopes": {"type": "list", "required": True},
-        "auth_dictionary": {"type": "dict", "required": True},
-        "user": {"type": "str", "required": True},
-        "receiver": {"type": "str", "required": True},
-        "matter_owner": {"type": "str", "required": True},
-        "bucket_name": {"type": "str", "required": True},
-        "download_path": {"type": "str", "required": True},
-        "storage_creds_path": {"type": "str", "required": True},
-    }
-
-    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=True)
-    gws = AnsibleGWS(module)
+    argument_spec = backup_argument_spec()
+    argument_spec.update(
+        {
+            "user": {"type": "str", "required": True},
+            # Vault corpora exported into the matter, each to its own archive
+            "corpora": {
+                "type": "list",
+                "elements": "str",
+                "default": ["MAIL"],
+                "choices": list(EXPORT_OPTIONS),
+            },
+            # When false, return the matter and export IDs as soon as the exports
+            # are created and let a later task pass them back to finish the backup
+            "wait_for_export": {"type": "bool", "default": True},
+            "matter_id": {"type": "str", "required": False},
+            # Export IDs keyed by corpus
+            "export_ids": {"type": "dict", "required": False},
+            # Data transfer ID returned alongside them, so the resuming task
+            # still waits for the transfer
+            "transfer_id": {"type": "str", "required": False},
+            # JSON file recording the stages reached, so a rerun resumes
+            "checkpoint_path": {"type": "path", "required": False},
+        }
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True,
+        required_if=[("archive_mode", "local", ["download_path"])],
+        required_together=[("matter_id", "export_ids")],
+    )
+    checkpoint = Checkpoint(module.params["checkpoint_path"])
+    export_checkpoints = checkpoint.section("exports")
+    gws = GWSBackup(module, checkpoint=checkpoint)
 
     user = module.params["user"]
     receiver = module.params["receiver"]
     matter_owner = module.params["matter_owner"]
     bucket_name = module.params["bucket_name"]
     path = module.params["download_path"]
+    user_name = user.split("@")[0]
 
-    user_details = gws.get_user(user)
-    receiver_details = gws.get_user(receiver)
-
-    # Transfer drive data
-    if user_details["suspended"] is False and receiver_details["suspended"] is False:
-        gws.transfer_data(user_details["id"], receiver_details["id"])
-    else:
-        module.fail_json(msg=f"User, {user}, or receiver, {receiver}, is suspended")
-
-    # Backup emails to GCS
-    # Matter is a container for exports. Exports exist within a matter
-    matter_owner_details = gws.get_user(matter_owner)
-    matter = gws.create_matter(user, matter_owner_details["id"])
-    export = gws.create_mail_export(user, matter["matterId"], bucket_name)
-    sleep = 0
-    while export["status"] != "COMPLETED":
-        time.sleep(10)
-        sleep += 10
-        if sleep > 600:
-            module.fail_json(
-                msg=f"Export took longer than 10 minutes to create. Timing out."
-            )
-        export = (
-            gws.vault_client.matters()
-            .exports()
-            .get(matterId=export["matterId"], exportId=export["id"])
-            .execute()
+    module.params["auth_dictionary"] = "REDACTED"
+    if checkpoint.get("stage") == "done":
+        module.exit_json(
+            changed=False,
+            msg=f"Backup of {user} already completed",
+            matter_id=checkpoint.get("matter_id"),
+            export_ids=checkpoint.get("export_ids"),
         )
 
-    # Download, zip up export files, upload to bucket, clean up files
-    for export_file in export["cloudStorageSink"]["files"]:
-        gws.download_file(path, export_file["bucketName"], export_file["objectName"])
-    gws.zip_files(path, user.split("@")[0])
-    gws.upload_zip(path, user.split("@")[0], bucket_name)
-    gws.delete_files(path)
+    # Stages recorded in the checkpoint, in order: transferred, matter_created,
+    # exports_created, done. Each export records its own archived, uploaded
+    # and done stages under "exports".
+    matter_id = module.params["matter_id"] or checkpoint.get("matter_id")
+    export_ids = dict(module.params["export_ids"] or checkpoint.get("export_ids", {}))
+    exports = {}
+    if module.params["transfer_id"] and not checkpoint.get("transfer_id"):
+        checkpoint.update(transfer_id=module.params["transfer_id"])
+    try:
+        if not module.params["export_ids"]:
+            if not checkpoint.get("transfer_id"):
+                user_details = gws.get_user(user)
+                receiver_details = gws.get_user(receiver)
+
+                # Transfer Drive and other application data
+                if (
+                    user_details["suspended"] is False
+                    and receiver_details["suspended"] is False
+                ):
+                    transfer = gws.transfer_data(
+                        user_details["id"], receiver_details["id"]
+                    )
+                    checkpoint.update(
+                        stage="transferred",
+                        transfer_id=transfer["id"],
+                        transfer_status=None,
+                    )
+                else:
+                    module.fail_json(
+                        msg=f"User, {user}, or receiver, {receiver}, is suspended"
+                    )
+
+            # Back up each corpus to GCS
+            # Matter is a container for exports. Exports exist within a matter
+            if not matter_id:
+                matter_owner_details = gws.get_user(matter_owner)
+                matter = gws.create_matter(
+                    user_name + " export matter", matter_owner_details["id"]
+                )
+                matter_id = matter["matterId"]
+                checkpoint.update(stage="matter_created", matter_id=matter_id)
+            # Every export is created up front so Vault runs them side by side
+            for corpus in module.params["corpora"]:
+                if corpus in export_ids:
+                    continue
+                exports[corpus] = gws.create_export(user, matter_id, corpus)
+                export_ids[corpus] = exports[corpus]["id"]
+                checkpoint.update(export_ids=dict(export_ids))
+            checkpoint.update(stage="exports_created")
+
+            if not module.params["wait_for_export"]:
+                module.exit_json(
+                    changed=True,
+                    msg="\n".join(gws.exit_messages),
+                    matter_id=matter_id,
+                    export_ids=export_ids,
+                    transfer_id=checkpoint.get("transfer_id"),
+                    api_stats=gws.executor.stats(),
+                )
+
+        # Resumed exports, skipping any already archived by an earlier run
+        for corpus, export_id in export_ids.items():
+            if corpus in exports:
+                continue
+            if export_checkpoints.section(corpus).get("stage") == "done":
+                continue
+            exports[corpus] = gws.get_export(matter_id, export_id)
+        corpora = {export["id"]: corpus for corpus, export in exports.items()}
+
+        messages = {corpus: [] for corpus in export_ids}
+
+        def archive(corpus, export):
+            export_checkpoint = export_checkpoints.section(corpus)
+            worker = GWSBackup(module, gws.credentials, gws.executor, export_checkpoint)
+            # Mail keeps the plain {user} archive name of single-corpus backups
+            name = user_name
+            if corpus != "MAIL":
+                name = f"{user_name}_{corpus.lower()}"
+            export_path = None
+            if path:
+                export_path = os.path.join(path, corpus.lower()) + "/"
+                os.makedirs(export_path, exist_ok=True)
+            try:
+                stats = worker.archive_export(name, export, export_path, bucket_name)
+                export_checkpoint.update(stage="done")
+                return stats
+            finally:
+                messages[corpus].extend(worker.exit_messages)
+
+        # Exports are archived in the order they complete, while the rest are
+        # still running. The transfer is polled on its own thread meanwhile and
+        # must have completed before the backup is done.
+        transfer_id = checkpoint.get("transfer_id")
+        poll_transfer = transfer_id and checkpoint.get("transfer_status") != "completed"
+        poller = GWSBackup(module, gws.credentials, gws.executor, checkpoint)
+        stop = threading.Event()
+        download_stats = {}
+        failures = []
+        with ThreadPoolExecutor(max_workers=len(exports) + 1) as pool:
+            try:
+                if poll_transfer:
+                    transfers = pool.submit(
+                        poller.wait_for_transfers, [transfer_id], stop
+                    )
+
+                archives = {}
+                for export in gws.wait_for_exports(list(exports.values())):
+                    corpus = corpora[export["id"]]
+                    if export["status"] == "FAILED":
+                        failures.append(f"Export {export['id']} ({corpus}) failed")
+                    else:
+                        archives[corpus] = pool.submit(archive, corpus, export)
+                for corpus, future in archives.items():
+                    try:
+                        download_stats[corpus] = future.result()
+                    except BackupError as e:
+                        failures.append(str(e))
+                    except Exception as e:
+                        failures.append(
+                            f"Failed to archive {corpus.lower()} export for {user}\n{e}"
+                        )
+                for corpus in export_ids:
+                    gws.exit_messages.extend(messages[corpus])
+
+                if poll_transfer:
+                    # A failed export fails the backup anyway, so the transfer
+                    # isn't waited for; it's polled again when the task reruns
+                    if failures:
+                        stop.set()
+                    transfer = transfers.result().get(transfer_id)
+                    gws.exit_messages.extend(poller.exit_messages)
+                    if transfer is not None:
+                        status = transfer["overallTransferStatusCode"]
+                        checkpoint.update(transfer_status=status)
+                        if status == "failed":
+                            # Cleared so a rerun submits the transfer again
+                            checkpoint.update(transfer_id=None)
+                            failures.append(f"Transfer {transfer_id} failed")
+                if failures:
+                    raise BackupError(
+                        "\n".join(failures), matter_id=matter_id, export_ids=export_ids
+                    )
+            finally:
+                stop.set()
+        checkpoint.update(stage="done")
+    except BackupError as e:
+        module.fail_json(
+            msg="\n".join(gws.exit_messages + [str(e)]),
+            api_stats=gws.executor.stats(),
+            **e.result,
+        )
 
     # Add check mode
 
-    module.params["auth_dictionary"] = "REDACTED"
-    module.exit_json(changed=bool(gws.exit_messages), msg="\n".join(gws.exit_messages))
+    module.exit_json(
+        changed=bool(gws.exit_messages),
+        msg="\n".join(gws.exit_messages),
+        matter_id=matter_id,
+        export_ids=export_ids,
+        transfer_id=checkpoint.get("transfer_id"),
+        transfer_status=checkpoint.get("transfer_status"),
+        api_stats=gws.executor.stats(),
+        download_stats=download_stats,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ansible.module_utils.basic import AnsibleModule
+from ansible_collections.striveworks.gws.plugins.module_utils.backup import (
+    BackupError,
+    GWSBackup,
+    backup_argument_spec,
+)
+
+DOCUMENTATION = """
+---
+module: gws_backup_users
+short_description: Backup Google Workspace users
+description: Transfers Drive data and backs up mail for several users, with every export in one matter
+requirements:
+  - google-crc32c, optional, to verify files and archives with CRC32C as well as MD5
+  - zstandard, for archive_format tar_zstd
+author: "Will Albers (@walbers)"
+"""
+
+
+def check_backups(module, gws, receiver_details):
+    # Check mode only reads the users, and reports the matter, transfers and
+    # exports a real run would start
+    receiver = module.params["receiver"]
+    matter_name = module.params["matter_name"]
+    backups = []
+    failures = []
+    for user in module.params["users"]:
+        try:
+            user_details = gws.get_user(user)
+        except BackupError as e:
+            failures.append(str(e))
+            continue
+        if user_details["suspended"] or receiver_details["suspended"]:
+            failures.append(f"User, {user}, or receiver, {receiver}, is suspended")
+            continue
+        backups.append(
+            {
+                "user": user,
+                "transfer": {
+                    "receiver": receiver,
+                    "applications": module.params["transfer_applications"],
+                },
+                "export": {"matter_name": matter_name, "corpus": "MAIL"},
+            }
+        )
+
+    result = {
+        "matter_name": matter_name,
+        "backups": backups,
+        "api_stats": gws.executor.stats(),
+    }
+    if failures:
+        module.fail_json(msg="\n".join(failures), **result)
+    module.exit_json(
+        changed=bool(backups),
+        msg=f"Would have backed up {len(backups)} users into matter: {matter_name}",
+        **result,
+    )
+
+
+def main():
+
+    argument_spec = backup_argument_spec()
+    argument_spec.update(
+        {
+            "users": {"type": "list", "elements": "str", "required": True},
+            "matter_name": {"type": "str", "default": "offboarding export matter"},
+            "max_exports_in_flight": {"type": "int", "default": 10},
+            # Workers for Drive transfers and for archiving completed exports
+            "parallelism": {"type": "int", "default": 4},
+        }
+    )
+
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True,
+        required_if=[("archive_mode", "local", ["download_path"])],
+    )
+    gws = GWSBackup(module)
+
+    users = module.params["users"]
+    receiver = module.params["receiver"]
+    matter_owner = module.params["matter_owner"]
+    bucket_name = module.params["bucket_name"]
+    download_path = module.params["download_path"]
+
+    module.params["auth_dictionary"] = "REDACTED"
+    try:
+        receiver_details = gws.get_user(receiver)
+        matter_owner_details = gws.get_user(matter_owner)
+        if module.check_mode:
+            check_backups(module, gws, receiver_details)
+        matter = gws.create_matter(
+            module.params["matter_name"], matter_owner_details["id"]
+        )
+    except BackupError as e:
+        module.fail_json(
+            msg="\n".join(gws.exit_messages + [str(e)]),
+            api_stats=gws.executor.stats(),
+            **e.result,
+        )
+
+    # Each user's transfer and archive run on a worker with its own messages;
+    # they are merged in the order users were given
+    backups = {user: {"user": user} for user in users}
+    messages = {user: [] for user in users}
+    failures = {}
+
+    def transfer(user):
+        worker = GWSBackup(module, gws.credentials, gws.executor)
+        try:
+            user_details = worker.get_user(user)
+            if user_details["suspended"] or receiver_details["suspended"]:
+                raise BackupError(
+                    f"User, {user}, or receiver, {receiver}, is suspended"
+                )
+            transfer = worker.transfer_data(user_details["id"], receiver_details["id"])
+            backups[user]["transfer_id"] = transfer["id"]
+        finally:
+            messages[user].extend(worker.exit_messages)
+
+    def archive(user, export):
+        worker = GWSBackup(module, gws.credentials, gws.executor)
+        user_name = user.split("@")[0]
+        path = None
+        if download_path:
+            path = os.path.join(download_path, user_name) + "/"
+            os.makedirs(path, exist_ok=True)
+        try:
+            return worker.archive_export(user_name, export, path, bucket_name)
+        finally:
+            messages[user].extend(worker.exit_messages)
+
+    # Started transfers are polled on their own thread while exports run
+    poller = GWSBackup(module, gws.credentials, gws.executor)
+    stop = threading.Event()
+    transfer_poll = ThreadPoolExecutor(max_workers=1)
+    with ThreadPoolExecutor(max_workers=max(1, module.params["parallelism"])) as pool:
+        transfers = {user: pool.submit(transfer, user) for user in users}
+        waiting = []
+        for user, future in transfers.items():
+            try:
+                future.result()
+                waiting.append(user)
+            except BackupError as e:
+                failures[user] = str(e)
+        transfer_users = {
+            backups[user]["transfer_id"]: user
+            for user in waiting
+            if "transfer_id" in backups[user]
+        }
+        finished_transfers = transfer_poll.submit(
+            poller.wait_for_transfers, list(transfer_users), stop
+        )
+
+        export_users = {}
+
+        def start_next():
+            while waiting:
+                user = waiting.pop(0)
+                try:
+                    export = gws.create_export(user, matter["matterId"])
+                except BackupError as e:
+                    failures[user] = str(e)
+                    continue
+                export_users[export["id"]] = user
+                backups[user]["export_id"] = export["id"]
+                return export
+            return None
+
+        # Only max_exports_in_flight exports run at once; each one finishing
+        # starts the next, and completed exports are archived while the rest
+        # are still being polled
+        running = []
+        max_exports_in_flight = max(1, module.params["max_exports_in_flight"])
+        while waiting and len(running) < max_exports_in_flight:
+            export = start_next()
+            if export is not None:
+                running.append(export)
+
+        archives = {}
+        try:
+            for export in gws.wait_for_exports(running, start_next):
+                user = export_users[export["id"]]
+                if export["status"] == "FAILED":
+                    failures[user] = f"Export {export['id']} failed"
+                else:
+                    archives[user] = pool.submit(archive, user, export)
+        except BackupError as e:
+            unfinished = set(export_users.values()) | set(waiting)
+            for user in unfinished - set(archives) - set(failures):
+                failures[user] = str(e)
+
+        for user, future in archives.items():
+            try:
+                backups[user]["download_stats"] = future.result()
+            except Exception as e:
+                failures[user] = f"Failed to archive export for {user}\n{e}"
+
+    # Transfers only matter for users whose exports succeeded, so polling stops
+    # with the transfers finished so far once every one of those users failed
+    if all(user in failures for user in transfer_users.values()):
+        stop.set()
+    try:
+        for transfer_id, transfer in finished_transfers.result().items():
+            user = transfer_users[transfer_id]
+            status = transfer["overallTransferStatusCode"]
+            backups[user]["transfer_status"] = status
+            if status == "failed" and user not in failures:
+                failures[user] = f"Transfer {transfer_id} failed"
+    except BackupError as e:
+        for user in transfer_users.values():
+            if "transfer_status" not in backups[user] and user not in failures:
+                failures[user] = str(e)
+    finally:
+        stop.set()
+        transfer_poll.shutdown()
+    gws.exit_messages.extend(poller.exit_messages)
+
+    for user in users:
+        gws.exit_messages.extend(messages[user])
+        backups[user]["failed"] = user in failures
+
+    result = {
+        "matter_id": matter["matterId"],
+        "backups": [backups[user] for user in users],
+        "api_stats": gws.executor.stats(),
+    }
+    if failures:
+        failure_messages = [failures[user] for user in users if user in failures]
+        module.fail_json(msg="\n".join(gws.exit_messages + failure_messages), **result)
+    module.exit_json(
+        changed=bool(gws.exit_messages), msg="\n".join(gws.exit_messages), **result
+    )
+
+
+if __name__ == "__main__":
+    main()
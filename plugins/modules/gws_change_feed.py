@@ -0,0 +1,242 @@
+import datetime
+import json
+import os
+import time
+import uuid
+from ansible.module_utils.basic import AnsibleModule
+from ansible_collections.striveworks.gws.plugins.module_utils.gws import (
+    GWSClient,
+    gws_argument_spec,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.state import (
+    StateCache,
+    state_argument_spec,
+)
+
+DOCUMENTATION = """
+---
+module: gws_change_feed
+short_description: Track Google Workspace changes made outside Ansible
+description: Marks users and groups changed out-of-band as dirty in the state cache used by gws_users and gws_groups, from admin audit log activity and from Directory watch channel notifications
+author: "Will Albers (@walbers)"
+"""
+
+# Audit log events can show up a few minutes after they happen, so every poll
+# re-reads this far behind the saved cursor. Events read again are only marked
+# for resources not checked since they happened.
+AUDIT_LOG_OVERLAP = datetime.timedelta(minutes=10)
+
+# Admin audit log parameters naming the changed resource
+AUDIT_LOG_RESOURCES = {"USER_EMAIL": "user", "GROUP_EMAIL": "group"}
+
+# Channels closer than this to expiring are replaced
+CHANNEL_RENEW_MARGIN = 3600
+
+WATCH_EVENTS = ["add", "delete", "makeAdmin", "undelete", "update"]
+
+
+def rfc3339(value):
+    # Millisecond precision, as the Reports API returns activity times
+    return value.strftime("%Y-%m-%dT%H:%M:%S.") + f"{value.microsecond // 1000:03d}Z"
+
+
+def parse_rfc3339(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def timestamp(value):
+    # Seconds since the epoch of an activity time, as cache entries record
+    return parse_rfc3339(value).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class AnsibleGWS(GWSClient):
+    @property
+    def reports_client(self):
+        return self.service("admin", "reports_v1")
+
+    def list_admin_activities(self, start_time):
+        try:
+            yield from self.paginate(
+                self.reports_client.activities().list,
+                userKey="all",
+                applicationName="admin",
+                startTime=start_time,
+                maxResults=1000,
+                fields="items(id(time),events(name,parameters(name,value))),nextPageToken",
+            )
+        except Exception as e:
+            self.module.fail_json(msg=f"Failed to list admin activities\n{e}")
+
+    def watch_users(self, event, address, token=None):
+        body = {"id": str(uuid.uuid4()), "type": "web_hook", "address": address}
+        if token:
+            body["token"] = token
+        try:
+            channel = self.execute(
+                self.client.users().watch(
+                    customer="my_customer", event=event, body=body
+                )
+            )
+            self.exit_messages.append(f"Registered watch channel for user {event}")
+            return channel
+        except Exception as e:
+            self.module.fail_json(
+                msg=f"Failed to register watch channel for user {event}\n{e}"
+            )
+
+    def stop_channel(self, channel):
+        try:
+            self.execute(
+                self.client.channels().stop(
+                    body={"id": channel["id"], "resourceId": channel["resourceId"]}
+                )
+            )
+            self.exit_messages.append(f"Stopped watch channel {channel['id']}")
+        except Exception as e:
+            # An expired channel is already gone
+            self.exit_messages.append(
+                f"Failed to stop watch channel {channel['id']}: {e}"
+            )
+
+
+def audit_log_resources(activities):
+    # Yields the user and group resources named in admin audit log events,
+    # along with the time of the newest activity seen
+    for activity in activities:
+        for event in activity.get("events", []):
+            for parameter in event.get("parameters", []):
+                kind = AUDIT_LOG_RESOURCES.get(parameter.get("name"))
+                if kind and parameter.get("value"):
+                    resource = f"{kind}/{parameter['value'].lower()}"
+                    yield resource, activity["id"]["time"]
+
+
+def notification_resources(notifications_dir):
+    # Notifications are the push request bodies written one JSON file each by
+    # whatever receives the channel's webhook, optionally wrapped as
+    # {"headers": ..., "body": ...}. Sync messages carry no user. A file's
+    # modification time stands in for when the change happened.
+    for file_name in sorted(os.listdir(notifications_dir)):
+        path = os.path.join(notifications_dir, file_name)
+        if not file_name.endswith(".json") or not os.path.isfile(path):
+            continue
+        with open(path) as f:
+            try:
+                notification = json.load(f)
+            except ValueError:
+                notification = {}
+        body = notification.get("body", notification) or {}
+        email = body.get("primaryEmail")
+        resource = f"user/{email.lower()}" if email else None
+        yield resource, path, os.path.getmtime(path)
+
+
+def main():
+
+    argument_spec = gws_argument_spec()
+    argument_spec.update(state_argument_spec())
+    argument_spec.update(
+        {
+            "state_cache_path": {"type": "path", "required": True},
+            # Poll the admin audit log for changes since the last run
+            "audit_log": {"type": "bool", "default": True},
+            # Directory of notification files to ingest and remove
+            "notifications_dir": {"type": "path", "required": False},
+            # HTTPS address receiving users().watch notifications. Channels
+            # are registered, and renewed before they expire, when given.
+            "watch_address": {"type": "str", "required": False},
+            "watch_token": {"type": "str", "required": False, "no_log": True},
+            "watch_events": {
+                "type": "list",
+                "elements": "str",
+                "default": WATCH_EVENTS,
+                "choices": WATCH_EVENTS,
+            },
+        }
+    )
+
+    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=True)
+    gws = AnsibleGWS(module)
+
+    cache = StateCache(
+        module.params["state_cache_path"], module.params["state_cache_max_age"]
+    )
+    # Changed resources, with the time of their latest change
+    changed = {}
+
+    def note_change(resource, changed_at):
+        changed[resource] = max(changed_at, changed.get(resource, changed_at))
+
+    if module.params["audit_log"]:
+        now = datetime.datetime.utcnow()
+        cursor = cache.feed.get("audit_log_cursor")
+        if cursor is None:
+            # First run: nothing is cached from before now, so start here
+            cache.feed["audit_log_cursor"] = rfc3339(now)
+        else:
+            start = parse_rfc3339(cursor) - AUDIT_LOG_OVERLAP
+            newest = cursor
+            for resource, activity_time in audit_log_resources(
+                gws.list_admin_activities(rfc3339(start))
+            ):
+                note_change(resource, timestamp(activity_time))
+                newest = max(newest, activity_time)
+            cache.feed["audit_log_cursor"] = newest
+
+    processed = []
+    if module.params["notifications_dir"]:
+        for resource, path, changed_at in notification_resources(
+            module.params["notifications_dir"]
+        ):
+            if resource:
+                note_change(resource, changed_at)
+            processed.append(path)
+
+    if module.params["watch_address"]:
+        channels = cache.feed.setdefault("channels", {})
+        for event in module.params["watch_events"]:
+            channel = channels.get(event)
+            if channel is not None and (
+                int(channel.get("expiration") or 0) / 1000
+                > time.time() + CHANNEL_RENEW_MARGIN
+            ):
+                continue
+            if module.check_mode:
+                gws.record_change("create", f"channel/users/{event}")
+                continue
+            if channel is not None:
+                gws.stop_channel(channel)
+            channel = gws.watch_users(
+                event, module.params["watch_address"], module.params["watch_token"]
+            )
+            channels[event] = {
+                "id": channel["id"],
+                "resourceId": channel["resourceId"],
+                "expiration": channel.get("expiration"),
+            }
+
+    marked = sorted(
+        resource
+        for resource, changed_at in changed.items()
+        if cache.mark_dirty(resource, changed_at)
+    )
+    if not module.check_mode:
+        cache.save()
+        # Notifications are only removed once the dirty set holding them is saved
+        for path in processed:
+            os.remove(path)
+    if marked:
+        gws.exit_messages.append(f"Marked {len(marked)} cached resources dirty")
+
+    module.params["auth_dictionary"] = "REDACTED"
+    module.exit_json(
+        **gws.result(
+            dirty=marked,
+            seen=len(changed),
+            audit_log_cursor=cache.feed.get("audit_log_cursor"),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
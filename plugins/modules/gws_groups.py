@@ -1,7 +1,20 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
 from ansible.module_utils.basic import AnsibleModule
-from googleapiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
+from ansible_collections.striveworks.gws.plugins.module_utils.diff import (
+    apply_member_plan,
+    desired_members,
+    diff_members,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.gws import (
+    GWSClient,
+    gws_argument_spec,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.state import (
+    StateCache,
+    desired_hash,
+    state_argument_spec,
+)
 
 DOCUMENTATION = """
 ---
@@ -12,176 +25,232 @@ author: "Will Albers (@walbers)"
 """
 
 
-class AnsibleGWS:
-    def __init__(self, module):
-        credentials = ServiceAccountCredentials.from_json_keyfile_dict(
-            module.params["auth_dictionary"], scopes=module.params["auth_scopes"]
-        )
-        credentials = credentials.create_delegated(module.params["auth_email"])
-        self.client = build("admin", "directory_v1", credentials=credentials)
-        self.module = module
-        self.exit_messages = []
+class GroupError(Exception):
+    pass
 
-    def get_all_groups(self):
-        try:
-            groups = self.client.groups().list().execute()
-        except Exception as e:
-            groups = None
-        return groups
 
-    def get_group(self, email):
-        try:
-            group = self.client.groups().get(groupKey=email).execute()
-        except Exception as e:
-            group = None
-        return group
+class AnsibleGWS(GWSClient):
+    def __init__(self, module, credentials=None, executor=None):
+        super().__init__(module, credentials, executor)
+        self.pending_member_changes = []
 
-    def get_group_members(self, email):
+    def list_groups(self):
         try:
-            members = self.client.members().list(groupKey=email).execute()
+            yield from self.paginate(
+                self.client.groups().list,
+                "groups",
+                customer="my_customer",
+                maxResults=200,
+                fields="groups(email,aliases,etag,directMembersCount),nextPageToken",
+            )
         except Exception as e:
-            self.module.fail_json(msg=f"Failed to get members for group: {email}")
-        return members
+            self.module.fail_json(msg=f"Failed to list groups\n{e}")
+
+    def get_all_groups(self):
+        groups = {}
+        for group in self.list_groups():
+            groups[group["email"].lower()] = group
+            for alias in group.get("aliases", []):
+                groups[alias.lower()] = group
+        return groups
 
     def create_group(self, name, email, description=None):
         try:
-            self.client.groups().insert(
-                body={
-                    "name": name,
-                    "email": email,
-                    "description": description,
-                }
-            ).execute()
+            self.execute(
+                self.client.groups().insert(
+                    body={
+                        "name": name,
+                        "email": email,
+                        "description": description,
+                    }
+                )
+            )
 
             self.exit_messages.append(f"Created group: {name}")
         except Exception as e:
-            self.fail_json(msg=f"Failed to create group: {name}")
+            raise GroupError(f"Failed to create group: {name}\n{e}")
 
     def create_group_member(self, group_email, member_email, role):
-        try:
+        self.queue_member_change(
             self.client.members().insert(
                 groupKey=group_email, body={"email": member_email, "role": role}
-            ).execute()
-            self.exit_messages.append(
-                f"Added user: {member_email} to group: {group_email} with role: {role}"
-            )
-        except Exception as e:
-            self.module.fail_json(
-                msg=f"Failed to add member: {member_email} to group: {group_email} with role: {role}\n{e}"
-            )
+            ),
+            f"Added user: {member_email} to group: {group_email} with role: {role}",
+            f"Failed to add member: {member_email} to group: {group_email} with role: {role}",
+        )
 
     def update_group_member(self, group_email, member_email, role):
-        try:
+        self.queue_member_change(
             self.client.members().patch(
                 groupKey=group_email, memberKey=member_email, body={"role": role}
-            ).execute()
-            self.exit_messages.append(
-                f"Updated user: {member_email} in group: {group_email} to role: {role}"
-            )
-        except Exception as e:
-            self.module.fail_json(
-                msg=f"Failed to update user: {member_email} in group: {group_email} to role: {role}\n{e}"
-            )
+            ),
+            f"Updated user: {member_email} in group: {group_email} to role: {role}",
+            f"Failed to update user: {member_email} in group: {group_email} to role: {role}",
+        )
 
     def delete_group_member(self, group_email, member_email):
-        try:
-            self.client.members().delete(groupKey=group_email, memberKey=member_email)
-            self.exit_messages.append(
-                f"Deleted user: {member_email} from group: {group_email}"
-            )
-        except Exception as e:
-            self.module.fail_json(
-                msg=f"Failed to delete user: {member_email} from group: {group_email}\n{e}"
-            )
-
+        self.queue_member_change(
+            self.client.members().delete(groupKey=group_email, memberKey=member_email),
+            f"Deleted user: {member_email} from group: {group_email}",
+            f"Failed to delete user: {member_email} from group: {group_email}",
+        )
 
-def main():
+    def queue_member_change(self, request, success_message, failure_message):
+        self.pending_member_changes.append((request, success_message, failure_message))
 
-    argument_spec = {
-        "auth_email": {"type": "str", "required": True},
-        "auth_scopes": {"type": "list", "required": True},
-        "auth_dictionary": {"type": "dict", "required": True},
-        "groups": {"type": "list", "required": True},
-        # "email": {"type": "str", "required": True},
-        # "name": {"type": "str", "required": False},
-        # "description": {"type": "str", "required": False},
-        # "members": {
-        #     "type": "list",
-        #     "required": False,
-        # },  # list of dictionaries of emails and roles
-    }
+    def execute_member_changes(self):
+        # Member mutations are sent as Admin SDK batch requests, one HTTP round-trip
+        # per 1000 changes
+        pending = self.pending_member_changes
+        self.pending_member_changes = []
+        failures = []
 
-    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=True)
-    gws = AnsibleGWS(module)
+        def callback(index, response, exception):
+            _, success_message, failure_message = pending[index]
+            if exception is None:
+                self.exit_messages.append(success_message)
+            else:
+                failures.append(f"{failure_message}\n{exception}")
 
-    # can use get all groups
+        try:
+            self.execute_batch([request for request, _, _ in pending], callback)
+        except Exception as e:
+            raise GroupError(f"Failed to execute batch of member changes\n{e}")
 
-    groups = module.params["groups"]
+        if failures:
+            raise GroupError(failures[0])
 
-    for group in groups:
+    def reconcile_group(self, group, gws_group, known_etag=None):
+        # Returns the group's etag when it was already in sync, otherwise None.
+        # known_etag is the etag the group had when last found in sync with
+        # this same declaration; members are listed whenever it's None.
         try:
             email = group["email"]
             name = group["name"]
             description = group.get("description")
             members = group["members"]
         except KeyError as e:
-            module.fail_json(msg=f"Group {email} is missing required key: {e}")
+            raise GroupError(f"Group {group.get('email')} is missing required key: {e}")
 
-        gws_group = gws.get_group(email)
         if gws_group is None:
-            if self.module.check_mode:
-                gws.exit_messages.append(f"Would have created group: {name}")
-            else:
-                gws.create_group(name, email, description)
-                group_members = []
+            self.record_change(
+                "create",
+                f"group/{email}",
+                after={"name": name, "description": description},
+            )
+            if not self.module.check_mode:
+                self.create_group(name, email, description)
+            group_members = {}
+        elif (
+            known_etag is not None
+            and known_etag == gws_group["etag"]
+            and members is not None
+            and int(gws_group.get("directMembersCount", 0)) == len(members)
+        ):
+            return gws_group["etag"]
         else:
-            group_members = gws.get_group_members(email).get("members")
-            if group_members is None:
-                group_members = {}
-            else:
-                group_members = {
-                    member["email"].lower(): member["role"] for member in group_members
-                }
-
-        member_email_set = set()
-        if members is not None:
-            for member in members:
-                if "@" not in member["email"]:
-                    module.fail_json(
-                        msg=f"Need valid email for member. Given: {member['email']}"
-                    )
-                elif member["role"] not in ["MEMBER", "MANAGER", "OWNER"]:
-                    module.fail_json(
-                        msg=f"Need valid role for member. Given: {member['role']}"
-                    )
-                elif member["email"] not in group_members:
-                    if module.check_mode:
-                        gws.exit_messages.append(
-                            f"Would have added member: {member['email']} to group: {email} with role: {member['role']}"
-                        )
-                    else:
-                        gws.create_group_member(email, member["email"], member["role"])
-                elif group_members[member["email"]] != member["role"]:
-                    if module.check_mode:
-                        gws.exit_messages.append(
-                            f"Would have updated member: {member['email']} in group: {email} to role: {member['role']}"
-                        )
-                    else:
-                        gws.update_group_member(email, member["email"], member["role"])
-                member_email_set.add(member["email"].lower())
-
-        need_to_remove = set(group_members.keys()) - member_email_set
-        if need_to_remove:
-            for member in need_to_remove:
-                if module.check_mode:
-                    gws.exit_messages.append(
-                        f"Would have removed: {member} from group: {email}"
-                    )
-                else:
-                    gws.delete_group_member(email, member)
+            try:
+                group_members = self.get_group_members(email)
+            except Exception as e:
+                raise GroupError(f"Failed to get members for group: {email}\n{e}")
+
+        try:
+            plan = diff_members(desired_members(members), group_members)
+        except ValueError as e:
+            raise GroupError(str(e))
+        apply_member_plan(self, email, plan, self.module.check_mode)
+
+        self.execute_member_changes()
+
+        if gws_group is not None and not self.changes:
+            return gws_group["etag"]
+        return None
+
+
+def main():
+
+    argument_spec = gws_argument_spec()
+    argument_spec.update(
+        {
+            "groups": {"type": "list", "required": True},
+            "parallelism": {"type": "int", "default": 1},
+        }
+    )
+    argument_spec.update(state_argument_spec())
+
+    module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=True)
+    gws = AnsibleGWS(module)
+
+    groups = module.params["groups"]
+    cache = StateCache(
+        module.params["state_cache_path"], module.params["state_cache_max_age"]
+    )
+    resources = [f"group/{str(group.get('email', '')).lower()}" for group in groups]
+    digests = [desired_hash(group, exclude=("etag",)) for group in groups]
+    fresh = [
+        cache.is_fresh(resource, digest) for resource, digest in zip(resources, digests)
+    ]
+    # Groups are only listed when some declaration needs checking
+    all_groups = gws.get_all_groups() if not all(fresh) else {}
+
+    def reconcile(index):
+        group = groups[index]
+        entry = cache.get(resources[index])
+        if fresh[index]:
+            return [], [], entry["etag"], None
+        # Cached entries are only re-checked once expired or dirty, to find
+        # changes made elsewhere, and member changes can keep a group's etag and
+        # member count. So members are always listed then, and only an etag
+        # declared as returned in etags, alongside the hash of the declaration
+        # it was recorded for, skips the listing of a group that isn't dirty.
+        known_etag = None
+        declared = group.get("etag")
+        if (
+            not cache.is_dirty(resources[index])
+            and isinstance(declared, dict)
+            and declared.get("hash") == digests[index]
+        ):
+            known_etag = declared.get("etag")
+        worker = AnsibleGWS(module, gws.credentials, gws.executor)
+        try:
+            gws_group = all_groups.get(str(group.get("email", "")).lower())
+            etag = worker.reconcile_group(group, gws_group, known_etag)
+            failure = None
+        except GroupError as e:
+            etag = None
+            failure = str(e)
+        return worker.exit_messages, worker.changes, etag, failure
+
+    with ThreadPoolExecutor(max_workers=max(1, module.params["parallelism"])) as pool:
+        results = list(pool.map(reconcile, range(len(groups))))
+
+    # Results come back in declaration order regardless of completion order
+    failures = []
+    # Etags of groups found in sync with the hash of their declaration, returned
+    # so the next run can skip them while the declaration is unchanged
+    etags = {}
+    for index, (messages, changes, etag, failure) in enumerate(results):
+        gws.exit_messages.extend(messages)
+        gws.changes.extend(changes)
+        if etag is not None:
+            etags[groups[index]["email"]] = {"etag": etag, "hash": digests[index]}
+        if failure is not None:
+            failures.append(failure)
+
+    # Groups reconciled without failure are cached with the etag they had when
+    # found in sync, or none when they were just changed
+    if not module.check_mode:
+        for index, (_, _, etag, failure) in enumerate(results):
+            if not fresh[index] and failure is None:
+                cache.update(resources[index], digests[index], etag)
+        cache.save()
 
     module.params["auth_dictionary"] = "REDACTED"
-    module.exit_json(changed=bool(gws.exit_messages), msg="\n".join(gws.exit_messages))
+    result = gws.result(etags=etags, skipped=sum(fresh))
+    if failures:
+        result["msg"] = "\n".join([result["msg"]] + failures).strip()
+        module.fail_json(**result)
+    module.exit_json(**result)
 
 
 if __name__ == "__main__":
@@ -15,31 +15,40 @@ import json
 import random
 import string
 from ansible.module_utils.basic import AnsibleModule
-from googleapiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
+from ansible_collections.striveworks.gws.plugins.module_utils.admin import (
+    load_role_index,
+    plan_super_admin,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.diff import (
+    USER_FIELDS,
+    diff_aliases,
+    diff_user,
+    user_attributes,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.gws import (
+    GWSClient,
+    gws_argument_spec,
+)
 
 DOCUMENTATION = """
 ---
 module: gws_user
 short_description: Manage Google Workspace users
 description: Manage Google Workspace users
+notes:
+  - admin_roles lists and assigns roles, which needs the https://www.googleapis.com/auth/admin.directory.rolemanagement scope in auth_scopes. is_admin only needs the user scope.
 author: "Will Albers (@walbers)"
 """
 
 
-class AnsibleGWS:
-    def __init__(self, module):
-        credentials = ServiceAccountCredentials.from_json_keyfile_dict(
-            module.params["auth_dictionary"], scopes=module.params["auth_scopes"]
-        )
-        credentials = credentials.create_delegated(module.params["auth_email"])
-        self.client = build("admin", "directory_v1", credentials=credentials)
-        self.module = module
-        self.exit_messages = []
-
+class AnsibleGWS(GWSClient):
     def get_user(self, email):
         try:
-            user = self.client.users().get(userKey=email).execute()
+            user = self.execute(
+                self.client.users().get(
+                    userKey=email, projection="basic", fields=USER_FIELDS
+                )
+            )
         except Exception as e:
             user = None
         return user
@@ -48,76 +57,116 @@ class AnsibleGWS:
         randchar = string.ascii_letters + string.digits + string.punctuation
         return "".join(random.choice(randchar) for i in range(12))
 
-    def create_user(
-        self, email, given_name, surname, role, suspended, password, is_admin
-    ):
+    def create_user(self, email, attributes, password):
+        body = {k: v for k, v in attributes.items() if k != "aliases"}
         try:
-            user = (
-                self.client.users()
-                .insert(
-                    body={
-                        "primaryEmail": email,
-                        "password": password,
-                        "isAdmin": is_admin,
-                        "suspended": suspended,
-                        "name": {"givenName": given_name, "familyName": surname},
-                        "changePasswordAtNextLogin": True,
-                    }
+            user = self.execute(
+                self.client.users().insert(
+                    body=dict(
+                        body,
+                        primaryEmail=email,
+                        password=password,
+                        changePasswordAtNextLogin=True,
+                    )
                 )
-                .execute()
             )
             self.exit_messages.append(
-                f"Created user: {email} with suspended: {suspended} and is_admin: {is_admin}"
+                f"Created user: {email} with suspended: {body['suspended']}"
             )
             return user
         except Exception as e:
-            self.module.fail_json(msg=f"Error creating user: {email}")
+            self.module.fail_json(msg=f"Error creating user: {email}\n{e}")
 
-    def update_user(self, email, suspended, is_admin):
+    def update_user(self, email, changes):
+        # Patches only the changed attributes
         try:
-            user = (
-                self.client.users()
-                .update(
-                    userKey=email,
-                    body={"suspended": suspended, "isAdmin": is_admin},
-                )
-                .execute()
-            )
+            user = self.execute(self.client.users().patch(userKey=email, body=changes))
             self.exit_messages.append(
-                f"Updated user: {email} with suspended: {suspended} and is_admin: {is_admin}"
+                f"Updated user: {email} with {json.dumps(changes, sort_keys=True)}"
             )
             return user
         except Exception as e:
-            self.module.fail_json(msg=f"Error updating user: {email}")
+            self.module.fail_json(msg=f"Error updating user: {email}\n{e}")
+
+    def apply_admin_change(self, email, user_id, change):
+        try:
+            self.execute(change.request(self, email, user_id))
+            self.exit_messages.append(change.message(email))
+        except Exception as e:
+            self.module.fail_json(
+                msg=f"Error changing role: {change.role_name} of {email}\n{e}"
+            )
+
+    def add_alias(self, email, alias):
+        try:
+            self.execute(
+                self.client.users()
+                .aliases()
+                .insert(userKey=email, body={"alias": alias})
+            )
+            self.exit_messages.append(f"Added alias: {alias} to user: {email}")
+        except Exception as e:
+            self.module.fail_json(msg=f"Error adding alias: {alias} to {email}\n{e}")
+
+    def delete_alias(self, email, alias):
+        try:
+            self.execute(
+                self.client.users().aliases().delete(userKey=email, alias=alias)
+            )
+            self.exit_messages.append(f"Deleted alias: {alias} from user: {email}")
+        except Exception as e:
+            self.module.fail_json(
+                msg=f"Error deleting alias: {alias} from {email}\n{e}"
+            )
 
 
 def main():
 
-    argument_spec = {
-        "auth_email": {"type": "str", "required": True},
-        "auth_scopes": {"type": "list", "required": True},
-        "auth_dictionary": {"type": "dict", "required": True},
-        "email": {"type": "str", "required": True},
-        "password": {"type": "str", "default": ""},
-        "given_name": {"type": "str", "required": True},
-        "surname": {"type": "str", "required": True},
-        "is_admin": {"type": "bool", "default": False},
-        "suspended": {"type": "bool", "default": False},
-    }
+    argument_spec = gws_argument_spec()
+    argument_spec.update(
+        {
+            "email": {"type": "str", "required": True},
+            "password": {"type": "str", "default": ""},
+            "given_name": {"type": "str", "required": True},
+            "surname": {"type": "str", "required": True},
+            "is_admin": {"type": "bool", "default": False},
+            # Custom admin role names; left unmanaged when not given
+            "admin_roles": {"type": "list", "elements": "str", "required": False},
+            "suspended": {"type": "bool", "default": False},
+            # Left unmanaged when not given
+            "org_unit_path": {"type": "str", "required": False},
+            "aliases": {"type": "list", "elements": "str", "required": False},
+        }
+    )
 
     module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=True)
     gws = AnsibleGWS(module)
 
     email = module.params["email"]
-    given_name = module.params["given_name"]
-    surname = module.params["surname"]
-    suspended = module.params["suspended"]
-    is_admin = module.params["is_admin"]
+    attributes = user_attributes(
+        module.params["given_name"],
+        module.params["surname"],
+        module.params["suspended"],
+        module.params["org_unit_path"],
+        module.params["aliases"],
+    )
 
     if email == "" or "@" not in email:
         module.fail_json(msg=f"Need valid email. Given: {email}")
 
     user = gws.get_user(email)
+    admin_changes = plan_super_admin(user, module.params["is_admin"])
+    # Roles are only listed when custom roles are managed
+    if module.params["admin_roles"] is not None:
+        try:
+            role_index = load_role_index(gws, email, with_assignments=user is not None)
+            admin_changes.extend(
+                role_index.plan(user and user["id"], module.params["admin_roles"])
+            )
+        except ValueError as e:
+            module.fail_json(msg=str(e))
+        except Exception as e:
+            module.fail_json(msg=f"Failed to list admin role assignments\n{e}")
 
     if user is None:
         password = (
@@ -125,24 +174,35 @@ def main():
             if module.params["password"]
             else gws.get_random_password()
         )
-        if module.check_mode:
-            module.exit_json(changed=True, msg=f"User {email} would be created")
-        else:
-            user = gws.create_user(
-                email, given_name, surname, is_admin, suspended, password, is_admin
-            )
-
-    elif user["suspended"] != suspended or user["isAdmin"] != is_admin:
-        if module.check_mode:
-            module.exit_json(
-                changed=True,
-                msg=f"User {email} would be updated with suspended: {suspended} and is_admin: {is_admin}",
-            )
-        else:
-            user = gws.update_user(email, suspended, is_admin)
+        gws.record_change("create", f"user/{email}", after=attributes)
+        if not module.check_mode:
+            user = gws.create_user(email, attributes, password)
+        add_aliases, delete_aliases = attributes.get("aliases", []), []
+    else:
+        before, after = diff_user(attributes, user)
+        patch = dict(after)
+        add_aliases, delete_aliases = diff_aliases(attributes, user)
+        if add_aliases or delete_aliases:
+            before["aliases"] = sorted(user.get("aliases", []))
+            after["aliases"] = attributes["aliases"]
+        if after:
+            gws.record_change("update", f"user/{email}", before, after)
+        if patch and not module.check_mode:
+            user = gws.update_user(email, patch)
+
+    for change in admin_changes:
+        change.record(gws, email)
+
+    if not module.check_mode:
+        for alias in add_aliases:
+            gws.add_alias(email, alias)
+        for alias in delete_aliases:
+            gws.delete_alias(email, alias)
+        for change in admin_changes:
+            gws.apply_admin_change(email, user["id"], change)
 
     module.params["auth_dictionary"] = "REDACTED"
-    module.exit_json(changed=bool(gws.exit_messages), msg="\n".join(gws.exit_messages))
+    module.exit_json(**gws.result())
 
 
 if __name__ == "__main__":
@@ -1,117 +1,280 @@
 import json
 import random
 import string
+from googleapiclient.errors import HttpError
 from ansible.module_utils.basic import AnsibleModule
-from googleapiclient.discovery import build
-from oauth2client.service_account import ServiceAccountCredentials
+from ansible_collections.striveworks.gws.plugins.module_utils.admin import (
+    load_role_index,
+    plan_super_admin,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.diff import (
+    USER_FIELDS,
+    diff_aliases,
+    diff_user,
+    user_attributes,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.gws import (
+    GWSClient,
+    gws_argument_spec,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.state import (
+    StateCache,
+    desired_hash,
+    state_argument_spec,
+)
 
 DOCUMENTATION = """
 ---
 module: gws_user
 short_description: Manage Google Workspace users
 description: Manage Google Workspace users
+notes:
+  - Users declaring admin_roles have roles listed and assigned, which needs the https://www.googleapis.com/auth/admin.directory.rolemanagement scope in auth_scopes. gws_admin only needs the user scope.
 author: "Will Albers (@walbers)"
 """
 
 
-class AnsibleGWS:
-    def __init__(self, module):
-        credentials = ServiceAccountCredentials.from_json_keyfile_dict(
-            module.params["auth_dictionary"], scopes=module.params["auth_scopes"]
-        )
-        credentials = credentials.create_delegated(module.params["auth_email"])
-        self.client = build("admin", "directory_v1", credentials=credentials)
-        self.module = module
-        self.exit_messages = []
+class AnsibleGWS(GWSClient):
+    def __init__(self, module, credentials=None, executor=None):
+        super().__init__(module, credentials, executor)
+        self.pending_user_changes = []
+        # Alias and admin role changes, sent after user changes once any new
+        # users exist
+        self.pending_followup_changes = []
+        self.failed = []
 
-    def get_user(self, email):
+    def get_user(self, email, cached=None):
+        # With a cached entry the read is conditional, and the cached state is
+        # returned when the server answers 304 Not Modified
+        request = self.client.users().get(
+            userKey=email, projection="basic", fields=USER_FIELDS
+        )
+        # States cached before isAdmin was read can't stand in for the user
+        if cached and cached.get("etag") and "isAdmin" in (cached.get("state") or {}):
+            request.headers["If-None-Match"] = cached["etag"]
         try:
-            user = self.client.users().get(userKey=email).execute()
+            user = self.execute(request)
+        except HttpError as e:
+            if int(e.resp.status) == 304:
+                return cached["state"]
+            user = None
         except Exception as e:
             user = None
         return user
 
+    def list_users(self):
+        try:
+            yield from self.paginate(
+                self.client.users().list,
+                "users",
+                customer="my_customer",
+                projection="basic",
+                maxResults=500,
+                fields=f"users({USER_FIELDS}),nextPageToken",
+            )
+        except Exception as e:
+            self.module.fail_json(msg=f"Failed to list users\n{e}")
+
+    def get_user_snapshot(self):
+        snapshot = {}
+        for user in self.list_users():
+            snapshot[user["primaryEmail"].lower()] = user
+            for alias in user.get("aliases", []):
+                snapshot[alias.lower()] = user
+        return snapshot
+
     def get_random_password(self):
         randchar = string.ascii_letters + string.digits + string.punctuation
         return "".join(random.choice(randchar) for i in range(12))
 
-    def create_user(
-        self, email, given_name, surname, role, suspended, password, is_admin
+    def create_user(self, email, attributes, password, on_success=None):
+        body = {k: v for k, v in attributes.items() if k != "aliases"}
+        self.queue_user_change(
+            "create",
+            email,
+            self.client.users().insert(
+                body=dict(
+                    body,
+                    primaryEmail=email,
+                    password=password,
+                    changePasswordAtNextLogin=True,
+                )
+            ),
+            f"Created user: {email} with suspended: {body['suspended']}",
+            on_success=on_success,
+        )
+
+    def update_user(self, email, changes):
+        # Patches only the changed attributes
+        self.queue_user_change(
+            "update",
+            email,
+            self.client.users().patch(userKey=email, body=changes),
+            f"Updated user: {email} with {json.dumps(changes, sort_keys=True)}",
+        )
+
+    def add_alias(self, email, alias):
+        self.queue_user_change(
+            "add_alias",
+            email,
+            self.client.users().aliases().insert(userKey=email, body={"alias": alias}),
+            f"Added alias: {alias} to user: {email}",
+            self.pending_followup_changes,
+        )
+
+    def delete_alias(self, email, alias):
+        self.queue_user_change(
+            "delete_alias",
+            email,
+            self.client.users().aliases().delete(userKey=email, alias=alias),
+            f"Deleted alias: {alias} from user: {email}",
+            self.pending_followup_changes,
+        )
+
+    def queue_admin_change(self, email, user_id, change):
+        self.queue_user_change(
+            change.operation,
+            email,
+            change.request(self, email, user_id),
+            change.message(email),
+            self.pending_followup_changes,
+        )
+
+    def queue_user_change(
+        self, operation, email, request, success_message, pending=None, on_success=None
     ):
-        try:
-            user = (
-                self.client.users()
-                .insert(
-                    body={
-                        "primaryEmail": email,
-                        "password": password,
-                        "isAdmin": is_admin,
-                        "suspended": suspended,
-                        "name": {"givenName": given_name, "familyName": surname},
-                        "changePasswordAtNextLogin": True,
-                    }
+        # on_success is called with the response, and may queue followup changes
+        if pending is None:
+            pending = self.pending_user_changes
+        pending.append((operation, email, request, success_message, on_success))
+
+    def execute_user_changes(self):
+        applied = self.execute_changes(self.pending_user_changes)
+        applied.extend(self.execute_changes(self.pending_followup_changes))
+        self.pending_user_changes = []
+        self.pending_followup_changes = []
+        return applied
+
+    def execute_changes(self, pending):
+        # Inserts and updates are sent as Admin SDK batch requests. Each item
+        # succeeds or fails on its own: successes are returned as applied and
+        # failures collected into self.failed rather than ending the run.
+        applied = []
+        answered = set()
+
+        def callback(index, response, exception):
+            operation, email, _, success_message, on_success = pending[index]
+            answered.add(index)
+            if exception is None:
+                self.exit_messages.append(success_message)
+                applied.append({"email": email, "operation": operation})
+                if on_success is not None:
+                    on_success(response)
+            else:
+                self.failed.append(
+                    {"email": email, "operation": operation, "error": str(exception)}
                 )
-                .execute()
-            )
-            self.exit_messages.append(
-                f"Created user: {email} with suspended: {suspended} and is_admin: {is_admin}"
-            )
-            return user
-        except Exception as e:
-            self.module.fail_json(
-                msg=f"Error creating user: {email}"
-            )  # add to exit message
 
-    def update_user(self, email, suspended, is_admin):
         try:
-            user = (
-                self.client.users()
-                .update(
-                    userKey=email,
-                    body={"suspended": suspended, "isAdmin": is_admin},
-                )
-                .execute()
-            )
-            self.exit_messages.append(
-                f"Updated user: {email} with suspended: {suspended} and is_admin: {is_admin}"
-            )
-            return user
+            self.execute_batch([change[2] for change in pending], callback)
         except Exception as e:
-            self.module.fail_json(
-                msg=f"Error updating user: {email}"
-            )  # add to exit message
+            # Items already answered keep their outcome; the rest are failed
+            for index, (operation, email, _, _, _) in enumerate(pending):
+                if index not in answered:
+                    self.failed.append(
+                        {"email": email, "operation": operation, "error": str(e)}
+                    )
+        return applied
 
 
 def main():
 
-    argument_spec = {
-        "auth_email": {"type": "str", "required": True},
-        "auth_scopes": {"type": "list", "required": True},
-        "auth_dictionary": {"type": "dict", "required": True},
-        "users": {"type": "list", "required": True},
-    }
+    argument_spec = gws_argument_spec()
+    argument_spec.update(
+        {
+            "users": {"type": "list", "required": True},
+            "snapshot": {"type": "bool", "default": False},
+        }
+    )
+    argument_spec.update(state_argument_spec())
 
     module = AnsibleModule(argument_spec=argument_spec, supports_check_mode=True)
     gws = AnsibleGWS(module)
 
     users = module.params["users"]
+    # The directory is only listed once some declaration needs checking
+    snapshot = None
+    cache = StateCache(
+        module.params["state_cache_path"], module.params["state_cache_max_age"]
+    )
+    # Declarations reconciled this run: email -> (resource, hash, user, changed)
+    reconciled = {}
+    skipped = 0
+    # Custom admin roles of every user are compared against one listing of the
+    # customer's role assignments, made once the first user declaring
+    # admin_roles needs it
+    role_index = None
     # module.fail_json(msg=f"Users: {users}")
     for ansible_user in users:
         try:
             email = ansible_user["email"]
-            given_name = ansible_user["givenname"]
-            surname = ansible_user["surname"]
-            suspended = ansible_user["suspended"]
             is_admin = ansible_user["gws_admin"]
+            attributes = user_attributes(
+                ansible_user["givenname"],
+                ansible_user["surname"],
+                ansible_user["suspended"],
+                ansible_user.get("org_unit_path"),
+                ansible_user.get("aliases"),
+            )
         except Exception as e:
-            module.fail_json(msg=f"User: {email} is missing required fields.\n{e}")
+            gws.failed.append(
+                {
+                    "email": ansible_user.get("email"),
+                    "operation": None,
+                    "error": f"Missing required field: {e}",
+                }
+            )
+            continue
 
         if email == "" or "@" not in email:
-            module.fail_json(
-                msg=f"Need valid email. Given: {email}"
-            )  # add to exit message
+            gws.failed.append(
+                {
+                    "email": email,
+                    "operation": None,
+                    "error": f"Need valid email. Given: {email}",
+                }
+            )
+            continue
 
-        user = gws.get_user(email)
+        resource = f"user/{email.lower()}"
+        digest = desired_hash(ansible_user, exclude=("password",))
+        if cache.is_fresh(resource, digest):
+            skipped += 1
+            continue
+
+        if not module.params["snapshot"]:
+            cached = cache.get(resource) if cache.matches(resource, digest) else None
+            user = gws.get_user(email, cached)
+        else:
+            if snapshot is None:
+                snapshot = gws.get_user_snapshot()
+            user = snapshot.get(email.lower())
+
+        changes_before = len(gws.changes)
+        admin_changes = plan_super_admin(user, is_admin)
+        if ansible_user.get("admin_roles") is not None:
+            if role_index is None:
+                try:
+                    role_index = load_role_index(gws)
+                except Exception as e:
+                    module.fail_json(msg=f"Failed to list admin role assignments\n{e}")
+            try:
+                admin_changes.extend(
+                    role_index.plan(user and user["id"], ansible_user["admin_roles"])
+                )
+            except ValueError as e:
+                gws.failed.append({"email": email, "operation": None, "error": str(e)})
+                continue
 
         if user is None:
             password = (
@@ -119,24 +282,67 @@ def main():
                 if ansible_user.get("password")
                 else gws.get_random_password()
             )
-            if module.check_mode:
-                gws.exit_messages.append(f"User {email} would be created")
-            else:
-                user = gws.create_user(
-                    email, given_name, surname, is_admin, suspended, password, is_admin
-                )
+            gws.record_change("create", f"user/{email}", after=attributes)
 
-        elif user["suspended"] != suspended or user["isAdmin"] != is_admin:
-            if module.check_mode:
-                gws.exit_messages.append(
-                    f"User {email} would be updated with suspended: {suspended} and is_admin: {is_admin}"
-                )
+            # Roles are assigned to the new user's ID once it exists
+            def grant_roles(response, email=email, admin_changes=admin_changes):
+                for change in admin_changes:
+                    gws.queue_admin_change(email, response["id"], change)
+
+            if not module.check_mode:
+                gws.create_user(email, attributes, password, grant_roles)
+            add_aliases, delete_aliases = attributes.get("aliases", []), []
+        else:
+            before, after = diff_user(attributes, user)
+            patch = dict(after)
+            add_aliases, delete_aliases = diff_aliases(attributes, user)
+            if add_aliases or delete_aliases:
+                before["aliases"] = sorted(user.get("aliases", []))
+                after["aliases"] = attributes["aliases"]
+            if after:
+                gws.record_change("update", f"user/{email}", before, after)
+            if patch and not module.check_mode:
+                gws.update_user(email, patch)
+            if not module.check_mode:
+                for change in admin_changes:
+                    gws.queue_admin_change(email, user["id"], change)
+
+        for change in admin_changes:
+            change.record(gws, email)
+        reconciled[email] = (resource, digest, user, len(gws.changes) > changes_before)
+
+        if not module.check_mode:
+            for alias in add_aliases:
+                gws.add_alias(email, alias)
+            for alias in delete_aliases:
+                gws.delete_alias(email, alias)
+
+    applied = gws.execute_user_changes()
+
+    # Users found in sync are cached with their etag and state, so the next
+    # run can skip them or read them conditionally. Changed users are cached
+    # without either, and are read in full the next time they are checked.
+    if not module.check_mode:
+        failed_emails = {item["email"] for item in gws.failed}
+        for email, (resource, digest, user, changed) in reconciled.items():
+            if email in failed_emails:
+                continue
+            if changed:
+                cache.update(resource, digest)
             else:
-                user = gws.update_user(email, suspended, is_admin)
+                cache.update(resource, digest, user.get("etag"), user)
+        cache.save()
 
     module.params["auth_dictionary"] = "REDACTED"
     module.params["users"] = "REDACTED"
-    module.exit_json(changed=bool(gws.exit_messages), msg="\n".join(gws.exit_messages))
+    # Applied changes are reported alongside failures, so a rerun after fixing
+    # the failed items only has those left to do
+    result = gws.result(applied=applied, failed=gws.failed, skipped=skipped)
+    if gws.failed:
+        failures = [f"{item['email']}: {item['error']}" for item in gws.failed]
+        result["msg"] = "\n".join([result["msg"]] + failures).strip()
+        module.fail_json(**result)
+    module.exit_json(**result)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+import pytest
+
+from ansible_collections.striveworks.gws.plugins.module_utils.admin import (
+    GRANT,
+    REVOKE,
+    SUPER_ADMIN,
+    RoleIndex,
+    plan_super_admin,
+)
+
+ROLES = [
+    {"roleId": "1", "roleName": "_SEED_ADMIN_ROLE", "isSuperAdminRole": True},
+    {"roleId": "2", "roleName": "Help Desk"},
+    {"roleId": "3", "roleName": "Groups Admin"},
+]
+
+
+def describe(changes):
+    return [(c.operation, c.role_name, c.assignment_id) for c in changes]
+
+
+def test_plan_super_admin_uses_is_admin():
+    assert plan_super_admin({"isAdmin": True}, True) == []
+    assert plan_super_admin({"isAdmin": False}, False) == []
+    assert describe(plan_super_admin({"isAdmin": False}, True)) == [
+        (GRANT, SUPER_ADMIN, None)
+    ]
+    assert describe(plan_super_admin({"isAdmin": True}, False)) == [
+        (REVOKE, SUPER_ADMIN, None)
+    ]
+    assert describe(plan_super_admin(None, True)) == [(GRANT, SUPER_ADMIN, None)]
+
+
+def test_role_index_plans_custom_roles_only():
+    index = RoleIndex(
+        ROLES,
+        [
+            {"roleAssignmentId": "a1", "roleId": "1", "assignedTo": "u1"},
+            {"roleAssignmentId": "a2", "roleId": "2", "assignedTo": "u1"},
+        ],
+    )
+
+    changes = index.plan("u1", ["Groups Admin", "_SEED_ADMIN_ROLE"])
+
+    assert describe(changes) == [
+        (GRANT, "Groups Admin", None),
+        (REVOKE, "Help Desk", "a2"),
+    ]
+    assert describe(index.plan(None, ["Help Desk"])) == [(GRANT, "Help Desk", None)]
+
+
+def test_role_index_rejects_unknown_roles():
+    with pytest.raises(ValueError, match="Nope"):
+        RoleIndex(ROLES, []).plan("u1", ["Nope"])
@@ -0,0 +1,82 @@
+import time
+
+import pytest
+
+from ansible_collections.striveworks.gws.plugins.module_utils.diff import (
+    ADD,
+    REMOVE,
+    UPDATE,
+    desired_members,
+    diff_members,
+)
+
+# Members in the benchmark group, and the time the diff must stay under. The
+# bound is loose so shared runners pass. Benchmarks only run with
+# --run-benchmarks; add -s to see the timing.
+BENCHMARK_MEMBERS = 100_000
+BENCHMARK_SECONDS = 2.0
+
+
+def member_map(count, prefix="user", role="MEMBER"):
+    return {f"{prefix}{i}@example.com": role for i in range(count)}
+
+
+def test_diff_members_operations():
+    desired = desired_members(
+        [
+            {"email": "Keep@Example.com", "role": "MEMBER"},
+            {"email": "promote@example.com", "role": "OWNER"},
+            {"email": "new@example.com", "role": "MANAGER"},
+        ]
+    )
+    actual = {
+        "keep@example.com": "MEMBER",
+        "promote@example.com": "MEMBER",
+        "gone@example.com": "MEMBER",
+    }
+
+    plan = diff_members(desired, actual)
+
+    assert [(c.operation, c.email, c.role, c.current_role) for c in plan] == [
+        (ADD, "new@example.com", "MANAGER", None),
+        (UPDATE, "promote@example.com", "OWNER", "MEMBER"),
+        (REMOVE, "gone@example.com", None, "MEMBER"),
+    ]
+
+
+def test_desired_members_rejects_invalid():
+    with pytest.raises(ValueError, match="email"):
+        desired_members([{"email": "nobody", "role": "MEMBER"}])
+    with pytest.raises(ValueError, match="role"):
+        desired_members([{"email": "a@example.com", "role": "ADMIN"}])
+
+
+def large_group():
+    # A tenth of the group is added, updated and removed each
+    tenth = BENCHMARK_MEMBERS // 10
+    actual = member_map(BENCHMARK_MEMBERS)
+    desired = dict(actual)
+    for i in range(tenth):
+        del desired[f"user{i}@example.com"]
+        desired[f"user{tenth + i}@example.com"] = "OWNER"
+        desired[f"new{i}@example.com"] = "MEMBER"
+    return desired, actual
+
+
+def test_diff_members_large_group():
+    desired, actual = large_group()
+    counts = {}
+    for change in diff_members(desired, actual):
+        counts[change.operation] = counts.get(change.operation, 0) + 1
+    tenth = BENCHMARK_MEMBERS // 10
+    assert counts == {ADD: tenth, UPDATE: tenth, REMOVE: tenth}
+
+
+@pytest.mark.benchmark
+def test_diff_members_100k_benchmark():
+    desired, actual = large_group()
+    start = time.perf_counter()
+    diff_members(desired, actual)
+    elapsed = time.perf_counter() - start
+    print(f"diff_members: {BENCHMARK_MEMBERS} members in {elapsed:.3f} seconds")
+    assert elapsed < BENCHMARK_SECONDS
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from ansible_collections.striveworks.gws.plugins.module_utils.state import (
+    StateCache,
+    desired_hash,
+)
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "state.json")
+    cache = StateCache(path)
+    cache.update("group/a@example.com", "hash-a", "etag-a")
+    cache.update("group/b@example.com", "hash-b", "etag-b")
+    cache.save()
+    return path
+
+
+def read(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_dirty_entries_are_not_fresh(path):
+    cache = StateCache(path)
+    assert cache.is_fresh("group/a@example.com", "hash-a")
+    assert cache.mark_dirty("group/a@example.com")
+    assert not cache.mark_dirty("group/c@example.com")
+    assert cache.is_dirty("group/a@example.com")
+    assert not cache.is_fresh("group/a@example.com", "hash-a")
+    assert cache.matches("group/a@example.com", "hash-a")
+
+
+def test_concurrent_saves_keep_dirty_marks_and_cursor(path):
+    reconcile = StateCache(path)
+    feed = StateCache(path)
+
+    feed.mark_dirty("group/a@example.com")
+    feed.mark_dirty("group/b@example.com")
+    feed.feed["audit_log_cursor"] = "2024-01-01T00:00:00.000Z"
+    feed.save()
+
+    # Loaded before the feed saved: updating a marked entry keeps its mark,
+    # and saving keeps the other mark and the cursor
+    reconcile.update("group/a@example.com", "hash-a", "etag-a")
+    reconcile.update("group/c@example.com", "hash-c", "etag-c")
+    reconcile.save()
+
+    entries = read(path)["entries"]
+    assert entries["group/a@example.com"]["dirty"]
+    assert entries["group/b@example.com"]["dirty"]
+    assert entries["group/c@example.com"]["etag"] == "etag-c"
+    assert read(path)["feed"] == {"audit_log_cursor": "2024-01-01T00:00:00.000Z"}
+
+    # Loaded after the mark: the update clears it
+    reconcile = StateCache(path)
+    reconcile.update("group/a@example.com", "hash-a", "etag-a")
+    reconcile.save()
+    assert not read(path)["entries"]["group/a@example.com"].get("dirty")
+    assert read(path)["entries"]["group/b@example.com"]["dirty"]
+
+
+def test_dirty_mark_applies_to_entries_cached_meanwhile(path):
+    feed = StateCache(path)
+    reconcile = StateCache(path)
+    reconcile.update("group/c@example.com", "hash-c", "etag-c")
+    reconcile.save()
+
+    assert not feed.mark_dirty("group/c@example.com")
+    feed.save()
+    assert read(path)["entries"]["group/c@example.com"]["dirty"]
+
+
+def test_desired_hash_ignores_excluded_keys():
+    group = {"email": "a@example.com", "members": [], "etag": "x"}
+    assert desired_hash(group, exclude=("etag",)) == desired_hash(
+        dict(group, etag="y"), exclude=("etag",)
+    )
+    assert desired_hash(group) != desired_hash(dict(group, etag="y"))
+
+
+def test_changes_seen_by_the_last_check_are_not_marked(path):
+    cache = StateCache(path)
+    checked = cache.get("group/a@example.com")["checked"]
+
+    assert not cache.mark_dirty("group/a@example.com", checked - 60)
+    assert not cache.is_dirty("group/a@example.com")
+    assert cache.mark_dirty("group/a@example.com", checked + 60)
+    assert cache.is_dirty("group/a@example.com")
@@ -0,0 +1,203 @@
+import contextlib
+import json
+import os
+from unittest import mock
+
+import pytest
+from ansible.module_utils import basic
+
+from ansible_collections.striveworks.gws.plugins.module_utils.gws import (
+    RequestExecutor,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.state import (
+    StateCache,
+)
+from ansible_collections.striveworks.gws.plugins.modules import gws_change_feed
+
+try:
+    from ansible.module_utils.testing import patch_module_args
+except ImportError:  # ansible-core before 2.19
+
+    @contextlib.contextmanager
+    def patch_module_args(args):
+        data = json.dumps({"ANSIBLE_MODULE_ARGS": args}).encode()
+        with mock.patch.object(basic, "_ANSIBLE_ARGS", data):
+            yield
+
+
+CURSOR = "2024-05-01T12:00:00.000Z"
+CHECKED = gws_change_feed.timestamp(CURSOR)
+
+
+def activity(time, name, value):
+    return {
+        "id": {"time": time},
+        "events": [{"name": "CHANGE", "parameters": [{"name": name, "value": value}]}],
+    }
+
+
+# Two pages of admin audit log activity: user a changed after its last check,
+# group g changed before it
+PAGES = {
+    None: {
+        "items": [activity("2024-05-01T12:05:00.000Z", "USER_EMAIL", "A@example.com")],
+        "nextPageToken": "2",
+    },
+    "2": {
+        "items": [activity("2024-05-01T11:55:00.000Z", "GROUP_EMAIL", "g@example.com")]
+    },
+}
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeActivities:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def list(self, **kwargs):
+        self.calls.append(kwargs)
+        return FakeRequest(PAGES[kwargs["pageToken"]])
+
+
+class FakeReports:
+    def __init__(self):
+        self.calls = []
+
+    def activities(self):
+        return FakeActivities(self.calls)
+
+
+@pytest.fixture
+def reports(monkeypatch):
+    reports = FakeReports()
+
+    class FakeGWS(gws_change_feed.AnsibleGWS):
+        def __init__(self, module):
+            super().__init__(module, object(), RequestExecutor(qps=1e6))
+
+        @property
+        def reports_client(self):
+            return reports
+
+    monkeypatch.setattr(gws_change_feed, "AnsibleGWS", FakeGWS)
+    return reports
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    path = str(tmp_path / "state.json")
+    entry = {"hash": "h", "etag": None, "state": None, "checked": CHECKED}
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "entries": {
+                    "user/a@example.com": dict(entry),
+                    "user/b@example.com": dict(entry),
+                    "group/g@example.com": dict(entry),
+                },
+                "feed": {"audit_log_cursor": CURSOR},
+            },
+            f,
+        )
+    return path
+
+
+def run_module(capsys, **args):
+    args = dict(
+        args,
+        auth_email="admin@example.com",
+        auth_scopes=["https://www.googleapis.com/auth/admin.reports.audit.readonly"],
+        auth_dictionary={},
+    )
+    with patch_module_args(args), pytest.raises(SystemExit):
+        gws_change_feed.main()
+    return json.loads(capsys.readouterr().out)
+
+
+def write_notification(directory, name, notification):
+    with open(os.path.join(directory, name), "w") as f:
+        json.dump(notification, f)
+
+
+def test_notification_resources(tmp_path):
+    directory = str(tmp_path)
+    write_notification(directory, "1.json", {"body": {"primaryEmail": "A@x.com"}})
+    write_notification(directory, "2.json", {"primaryEmail": "b@x.com"})
+    write_notification(directory, "3.json", {"kind": "api#channel"})
+    with open(os.path.join(directory, "4.json"), "w") as f:
+        f.write("not json")
+    with open(os.path.join(directory, "ignored.txt"), "w") as f:
+        f.write("{}")
+
+    resources = [
+        (resource, os.path.basename(path))
+        for resource, path, _ in gws_change_feed.notification_resources(directory)
+    ]
+
+    assert resources == [
+        ("user/a@x.com", "1.json"),
+        ("user/b@x.com", "2.json"),
+        (None, "3.json"),
+        (None, "4.json"),
+    ]
+
+
+def test_audit_log_resources():
+    activities = PAGES[None]["items"] + PAGES["2"]["items"]
+    activities.append(activity("2024-05-01T12:06:00.000Z", "OTHER", "x"))
+
+    assert list(gws_change_feed.audit_log_resources(activities)) == [
+        ("user/a@example.com", "2024-05-01T12:05:00.000Z"),
+        ("group/g@example.com", "2024-05-01T11:55:00.000Z"),
+    ]
+
+
+def test_first_poll_only_sets_the_cursor(reports, capsys, tmp_path):
+    path = str(tmp_path / "state.json")
+
+    result = run_module(capsys, state_cache_path=path)
+
+    assert reports.calls == []
+    assert result["audit_log_cursor"] == StateCache(path).feed["audit_log_cursor"]
+
+
+def test_poll_marks_changed_resources(reports, capsys, state_path, tmp_path):
+    notifications = str(tmp_path / "notifications")
+    os.makedirs(notifications)
+    write_notification(notifications, "1.json", {"primaryEmail": "b@example.com"})
+
+    result = run_module(
+        capsys, state_cache_path=state_path, notifications_dir=notifications
+    )
+
+    # The poll re-reads the overlap before the cursor, across both pages
+    assert [call["startTime"] for call in reports.calls] == [
+        "2024-05-01T11:50:00.000Z",
+        "2024-05-01T11:50:00.000Z",
+    ]
+    assert [call["pageToken"] for call in reports.calls] == [None, "2"]
+    assert result["dirty"] == ["user/a@example.com", "user/b@example.com"]
+    assert result["audit_log_cursor"] == "2024-05-01T12:05:00.000Z"
+    assert os.listdir(notifications) == []
+
+    cache = StateCache(state_path)
+    assert cache.is_dirty("user/a@example.com")
+    assert not cache.is_dirty("group/g@example.com")
+
+    # Once reconciled, the same events read again in the overlap don't mark
+    # the user again
+    cache.update("user/a@example.com", "h")
+    cache.save()
+    reports.calls.clear()
+    result = run_module(capsys, state_cache_path=state_path)
+
+    assert reports.calls[0]["startTime"] == "2024-05-01T11:55:00.000Z"
+    assert result["dirty"] == []
+    assert not StateCache(state_path).is_dirty("user/a@example.com")
@@ -0,0 +1,128 @@
+import re
+
+import httplib2
+import pytest
+
+from ansible_collections.striveworks.gws.plugins.module_utils.discovery import (
+    build_service,
+)
+from ansible_collections.striveworks.gws.plugins.module_utils.gws import (
+    RequestExecutor,
+)
+from ansible_collections.striveworks.gws.plugins.modules import gws_groups
+
+BOUNDARY = "batch_response"
+
+
+class FakeServer:
+    # Stands in for httplib2.Http under a Directory client built from the
+    # bundled discovery document. Every batch is a real multipart request; each
+    # part is answered with status.
+    def __init__(self, status="200 OK"):
+        self.status = status
+        self.round_trips = 0
+        self.batch_sizes = []
+        self.requests = []
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self.round_trips += 1
+        assert method == "POST" and uri.endswith("/batch")
+        body = body.decode() if isinstance(body, bytes) else body
+        parts = re.findall(r"Content-ID: <(.+?) \+ (.+?)>\s+(\w+) (\S+)", body)
+        self.batch_sizes.append(len(parts))
+        responses = []
+        for base, request_id, part_method, part_uri in parts:
+            self.requests.append((part_method, part_uri))
+            responses.append(
+                f"--{BOUNDARY}\r\n"
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{base} + {request_id}>\r\n\r\n"
+                f"HTTP/1.1 {self.status}\r\n"
+                "Content-Type: application/json\r\n\r\n"
+                "{}\r\n"
+            )
+        content = "".join(responses) + f"--{BOUNDARY}--\r\n"
+        response = httplib2.Response(
+            {
+                "status": "200",
+                "content-type": f"multipart/mixed; boundary={BOUNDARY}",
+            }
+        )
+        return response, content.encode()
+
+
+class FakeModule:
+    check_mode = False
+    params = {"plan_path": None}
+
+    def fail_json(self, **kwargs):
+        raise AssertionError(kwargs.get("msg"))
+
+
+class FakeGWS(gws_groups.AnsibleGWS):
+    def __init__(self, server):
+        super().__init__(FakeModule(), object(), RequestExecutor(qps=1e6))
+        self.directory = build_service("admin", "directory_v1", http=server)
+
+    @property
+    def client(self):
+        return self.directory
+
+
+@pytest.fixture
+def server():
+    return FakeServer()
+
+
+def test_member_changes_are_batched(server):
+    gws = FakeGWS(server)
+    for i in range(1000):
+        gws.create_group_member("team@example.com", f"add{i}@example.com", "MEMBER")
+    for i in range(1000):
+        gws.update_group_member("team@example.com", f"upd{i}@example.com", "OWNER")
+    for i in range(500):
+        gws.delete_group_member("team@example.com", f"del{i}@example.com")
+
+    gws.execute_member_changes()
+
+    assert server.round_trips == 3
+    assert server.batch_sizes == [1000, 1000, 500]
+    methods = [method for method, _ in server.requests]
+    assert methods == ["POST"] * 1000 + ["PATCH"] * 1000 + ["DELETE"] * 500
+    assert len(gws.exit_messages) == 2500
+    assert gws.pending_member_changes == []
+
+
+def test_member_change_failure_is_raised():
+    server = FakeServer("404 Not Found")
+    gws = FakeGWS(server)
+    gws.create_group_member("team@example.com", "a@example.com", "MEMBER")
+
+    with pytest.raises(gws_groups.GroupError, match="a@example.com"):
+        gws.execute_member_changes()
+    assert server.round_trips == 1
+
+
+def test_members_listed_without_trusted_etag(server):
+    gws = FakeGWS(server)
+    listed = []
+
+    def get_group_members(email):
+        listed.append(email)
+        return {"old@example.com": "MEMBER"}
+
+    gws.get_group_members = get_group_members
+    group = {
+        "email": "team@example.com",
+        "name": "Team",
+        "members": [{"email": "new@example.com", "role": "MEMBER"}],
+        "etag": "abc",
+    }
+    gws_group = {"etag": "abc", "directMembersCount": "1"}
+
+    assert gws.reconcile_group(group, gws_group, known_etag="abc") == "abc"
+    assert listed == []
+
+    assert gws.reconcile_group(group, gws_group) is None
+    assert listed == ["team@example.com"]
+    assert server.batch_sizes == [2]